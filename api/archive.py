@@ -0,0 +1,111 @@
+'已结束场次的弹幕归档(按列存储后压缩, 装了zstandard时用zstd, 没有的话用标准库的zlib)'
+import asyncio, datetime, zlib
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from db.models import ClipArchive, ClipInfo, Comments, Subtitles
+from static import config
+from .codec import loads, dumps
+
+ARCHIVE_COLUMNS = (
+    'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 'gift_num', 'text'
+    ) # 与/clip/{id}/comments返回的字段一致, time为毫秒时间戳
+OPTIONAL_COLUMNS = ('superchat_price', 'gift_name') # 为null时不返回的字段
+
+def compress(data:bytes):
+    '-> (压缩方式, 压缩后的数据)'
+    level = config.archive.get('level', 3)
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=level).compress(data)
+    return "zlib", zlib.compress(data, level)
+
+def decompress(codec:str, data:bytes):
+    '按压缩方式解压'
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archive")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def pack(danmakus_json:bytes, columns_json:bytes):
+    '''数据库里序列化好的JSON数组和按列数据 -> (压缩方式, 压缩后的按列数据, 压缩后的JSON数组)
+    两份都是现成的bytes, 不用再解析/序列化'''
+    codec, data = compress(columns_json)
+    _, json_data = compress(danmakus_json)
+    return codec, data, json_data
+
+def unpack_columns(codec:str, data:bytes):
+    '按列存储并压缩后的数据 -> {字段: 每条弹幕的值}'
+    return loads(decompress(codec, data))
+
+def unpack(codec:str, data:bytes):
+    '按列存储并压缩后的数据 -> 弹幕列表'
+    columns = unpack_columns(codec, data)
+    danmakus = [dict(zip(ARCHIVE_COLUMNS, values)) for values in zip(*(columns[c] for c in ARCHIVE_COLUMNS))]
+    for c in OPTIONAL_COLUMNS:
+        for danmaku, value in zip(danmakus, columns[c]):
+            if value is None:
+                del danmaku[c]
+    return danmakus
+
+async def read_json(clip_id:str):
+    '''读取场次的归档 -> 弹幕列表的JSON数组(utf-8), 没有归档时返回None
+    之前生成的归档没有存JSON, 从按列数据转换'''
+    archive = await ClipArchive.get_or_none(clip_id=clip_id)
+    if archive is None:
+        return None
+    if archive.json_data is not None:
+        return decompress(archive.codec, archive.json_data)
+    return dumps(unpack(archive.codec, archive.data))
+
+async def read_columns(clip_id:str):
+    '读取场次的归档 -> {字段: 每条弹幕的值}, 没有归档时返回None'
+    archive = await ClipArchive.get_or_none(clip_id=clip_id)
+    if archive is None:
+        return None
+    return unpack_columns(archive.codec, archive.data)
+
+async def is_writable(clip_id:str):
+    '''是否可以(重新)生成场次的归档
+    没有开启归档, 或者热表里的弹幕已经清理掉(重新生成的话会丢数据)时不写'''
+    if not config.archive.get('enabled', True):
+        return False
+    if await ClipArchive.exists(clip_id=clip_id, pruned=True):
+        logger.warning(f"Archive of clip {clip_id} is pruned, skipping...")
+        return False
+    return True
+
+async def save(clip_id:str, danmakus_json:bytes, columns_json:bytes, total_items:int):
+    '''把场次的所有弹幕(已按时间排序, 数据库里序列化好的JSON数组和按列数据)写进归档, 已存在时覆盖
+    不能写的时候(见is_writable)跳过'''
+    if not await is_writable(clip_id):
+        return False
+    codec, data, json_data = await asyncio.to_thread(pack, danmakus_json, columns_json)
+    await ClipArchive.update_or_create(
+        clip_id=clip_id, defaults={'codec': codec, 'data': data, 'json_data': json_data, 'total_items': total_items}
+        )
+    logger.debug(f"Clip archived: {clip_id} ({total_items} items, {len(data) + len(json_data)} bytes)")
+    return True
+
+async def delete(clip_id:str):
+    '删除场次的归档'
+    await ClipArchive.filter(clip_id=clip_id).delete()
+
+async def prune():
+    '''把结束超过prune_after_days天并且已经归档的场次从弹幕/字幕表里删掉(缩小表和索引)
+    删掉之后这些场次的弹幕只能从归档里读, 搜索和用户发言查询里不再出现'''
+    days = config.archive.get('prune_after_days', 0)
+    if not config.archive.get('enabled', True) or days <= 0:
+        return
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    clip_ids = await ClipInfo.filter(end_time__lt=cutoff).values_list('clip_id', flat=True)
+    archived = await ClipArchive.filter(clip_id__in=clip_ids, pruned=False).values_list('clip_id', flat=True)
+    for clip_id in archived:
+        await Comments.filter(clip_id=clip_id).delete()
+        await Subtitles.filter(clip_id=clip_id).delete()
+        await ClipArchive.filter(clip_id=clip_id).update(pruned=True)
+        logger.info(f"Pruned archived clip: {clip_id}")
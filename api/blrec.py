@@ -1,64 +1,42 @@
 'blrec相关API'
-import functools
 from loguru import logger
-from tortoise.exceptions import MultipleObjectsReturned
+from tortoise.transactions import in_transaction
 
 from db.models import ClipInfo, Channels, Comments
-#from static import config
-from .parse import get_danmakus_info, get_room_info, get_uuid, float_to_decimal
-
-def __count_danmakus(clip_list:list):
-    '计算弹幕总数'
-    #return functools.reduce(lambda x,y:x+y['total_danmu'], clip_list, initial=0)
-    return sum([i['total_danmu'] for i in clip_list])
+from db.writer import bulk_insert, HASHED_COMMENT_COLUMNS
+from static import config
+from .matsuri import refresh_clip, refresh_channels, refresh_viewer_activity, refresh_guard_ledger, archive_clip, \
+    invalidate_channel, invalidate_clip, CHANNEL_STATS_SQL
+from .codec import dumps
+from .parse import read_danmakus_header, parse_chunk, run_in_pool, finish_danmakus_info, \
+    DanmakuSummary, get_room_info, float_to_decimal, date_to_mili_timestamp
 
 async def update_user(data, is_live):
-    '更新主鳖信息'
-    # 获取场次信息
+    '''更新主鳖信息
+    场次数/弹幕数直接在数据库里聚合, 和直播间信息一起用一条INSERT ... ON CONFLICT写入'''
     uid = data['data']['room_info']['uid']
-    user_clips = await ClipInfo.filter(bilibili_uid=uid).all().order_by('start_time').values(
-        'total_danmu', 'start_time'
-    )
-    total_clip = len(user_clips)
-    if total_clip > 0:
-        last_clip = user_clips[-1]
-        last_live = last_clip['start_time']
-        last_danmu = last_clip['total_danmu']
-        total_danmu = __count_danmakus(user_clips)
-    else:
-        last_live = None
-        last_danmu = 0
-        total_danmu = 0
-
-    # 提取频道信息
     room_id = data['data']['room_info']['room_id']
-    channel_info = {
-        'is_live': is_live,
-        'last_danmu': last_danmu,
-        'total_clips': total_clip,
-        'total_danmu': total_danmu,
-        'last_live': last_live,
-    }
-    if data['data'].get('user_info', None) is not None:
-        # 如果是RecordingFinishedEvent就没有user_info这一项, 暂不更新
-        channel_info.update({
-            'name': data['data']['user_info']['name'],
-            'face': data['data']['user_info']['face'],
-        })
-
-    # 更新或者创建
-    channel = await Channels.get_or_none(bilibili_live_room = room_id)
-    if channel:
-        channel_info['hidden'] = channel.hidden
-        await Channels.filter(bilibili_live_room = room_id).update(**channel_info)
+    user_info = data['data'].get('user_info', None)
+    # 如果是RecordingFinishedEvent就没有user_info这一项, 暂不更新
+    update_columns = ['is_live', 'total_clips', 'total_danmu', 'last_danmu', 'last_live']
+    if user_info is not None:
+        update_columns.extend(['name', 'face'])
     else:
-        channel_info.update({
-            'bilibili_uid': uid,
-            'bilibili_live_room': room_id,
-            'hidden': False,
-            'archive': False,
-        })
-        await Channels.create(**channel_info)
+        user_info = {'name': "", 'face': ""}
+
+    sql = f'''
+        INSERT INTO "channels" (
+            "bilibili_live_room", "bilibili_uid", "is_live", "name", "face", "hidden", "archive",
+            "total_clips", "total_danmu", "last_danmu", "last_live"
+            )
+        SELECT $1, $2, $3, $4, $5, FALSE, FALSE,
+            coalesce(s."total_clips", 0), coalesce(s."total_danmu", 0), coalesce(s."last_danmu", 0), s."last_live"
+        FROM (SELECT 1) AS d LEFT JOIN ({CHANNEL_STATS_SQL.format(where='WHERE "bilibili_uid" = $2')}) AS s ON TRUE
+        ON CONFLICT ("bilibili_live_room") DO UPDATE SET
+            {', '.join(f'"{c}" = EXCLUDED."{c}"' for c in update_columns)}
+        '''
+    await Channels._meta.db.execute_query(sql, [room_id, uid, is_live, user_info['name'], user_info['face']])
+    invalidate_channel(uid)
 
 async def start_clip(data):
     '开始录制'
@@ -86,91 +64,109 @@ async def update_clip(data):
         is_live=is_live
         )
 
-    # 解析弹幕文件
-    danmakus_info = get_danmakus_info(data)
-    title = danmakus_info['title']
-    live_start_time = danmakus_info['live_start_time']
-    # record_start_time = danmakus_info['record_start_time']
-    end_time = danmakus_info['end_time']
+    # 在进程池里边解析弹幕文件边分批写入
+    # 每条弹幕带内容哈希, 已经写入过的弹幕(重复上传/分段重叠)直接跳过
+    # 场次信息和弹幕在同一个事务里写入, 中途失败重试时不会出现弹幕已经写入但场次信息没有更新的情况
+    header = read_danmakus_header(data)
+    summary = DanmakuSummary(uid=uid, start_ts=date_to_mili_timestamp(header['record_start_time']))
+    batch_size = config.parse.get('batch_size', 5000)
+    offset = 0
+    total_inserted = 0
+    async with in_transaction() as tx:
+        # 同一场次的分段可能同时被多个worker写入, 按场次加事务级的锁排队
+        await tx.execute_query('SELECT pg_advisory_xact_lock(hashtext($1))', [header['clip_id']])
+        while offset is not None:
+            batch, summary, offset = await run_in_pool(parse_chunk, header, summary, offset, batch_size)
+            if len(batch) > 0:
+                inserted = await bulk_insert(
+                    Comments, batch.records(with_hash=True), 
+                    columns=HASHED_COMMENT_COLUMNS, ignore_conflicts=True
+                    )
+                total_inserted += len(batch) if inserted is None else inserted
 
-    danmu_density = danmakus_info['danmu_density']
-    total_danmu = danmakus_info['total_danmakus']
-    total_gift = danmakus_info['total_gift']
-    total_superchat = danmakus_info['total_superchat']
-    total_reward = danmakus_info['total_reward']
-    highlights = danmakus_info['highlights']
-    viewers = danmakus_info['viewers']
+        danmakus_info = finish_danmakus_info(header, summary)
+        live_start_time = danmakus_info['live_start_time']
+        end_time = danmakus_info['end_time']
+        clip_id = danmakus_info['clip_id'] # 获取场次ID
+        logger.debug(f"Clip ID: {clip_id}")
 
-    # 检查是不是这段已经上传过了
-    d = danmakus_info['last_danmaku']
-    try:
-        is_duplicate = await Comments.get_or_none(**d) is not None
-    except MultipleObjectsReturned:
-        is_duplicate = True
-    if d == {}:
-        # 弹幕为空
-        logger.warning(f"No danmakus found in {filename}, skipping...")
-        # return
-    elif is_duplicate:
-        # 最后一条弹幕已存在
-        logger.debug(f"Duplicate: {d}")
-        logger.warning(f"Duplicated danmakus detected in {filename}, skipping...")
-        # return
-    else:
-        # 弹幕不为空且最后一条弹幕在弹幕库里不存在
-        danmakus_list = danmakus_info['danmakus']
-        await Comments.bulk_create(danmakus_list)
-        # AllComments.bulk_create(danmakus_list)
+        if summary.total_danmakus == 0:
+            # 弹幕为空
+            logger.warning(f"No danmakus found in {filename}, skipping...")
+        elif total_inserted == 0:
+            # 整个文件都已经写入过(重复上传/上次写入后的步骤失败重试), 不再累加统计, 只重新运行下面的刷新
+            logger.warning(f"Duplicated danmakus detected in {filename}, skipping...")
+        elif total_inserted < summary.total_danmakus:
+            logger.warning(
+                f"{summary.total_danmakus - total_inserted} duplicated danmakus skipped in {filename}"
+                )
 
-    # 获取场次ID
-    clip_id = danmakus_info['clip_id']
+        if total_inserted > 0 or summary.total_danmakus == 0:
+            await __update_clip_info(danmakus_info, username, uid, cover)
 
-    # 更新场次信息
-    logger.debug(f"Clip ID: {clip_id}")
-    clip_info = {
-        'name': username,
-        'bilibili_uid': uid,
-        'title': title,
-        'start_time': live_start_time,
-        'end_time': end_time,
-        'cover': cover,
-    }
-    last_clip = await ClipInfo.get_or_none(clip_id=clip_id)
-    if last_clip:
-        # 自动合并进之前的分段
-        last_clip = await ClipInfo.filter(clip_id=clip_id).order_by('start_time').first()
-        total_danmu = total_danmu + last_clip.total_danmu
-        total_minutes = (end_time - live_start_time).total_seconds()/60
-        clip_info.update({
-            'danmu_density': float_to_decimal(total_danmu/total_minutes, 3),
-            'total_danmu': total_danmu,
-            'total_gift': float_to_decimal(total_gift + last_clip.total_gift),
-            'total_superchat': float_to_decimal(total_superchat + last_clip.total_superchat),
-            'total_reward':  float_to_decimal(total_reward + last_clip.total_reward),
-            'highlights': last_clip.highlights + highlights,
-            'viewers': viewers,
-        })
-        await ClipInfo.filter(clip_id=clip_id).update(**clip_info)
-        clip_info.pop('highlights')
-        logger.debug(f"Updated: {clip_info}")
-    else:
-        # 新建分段
-        clip_info.update({
-            'clip_id': clip_id,
-            'bilibili_uid': uid,
-            'danmu_density': float_to_decimal(danmu_density, 3),
-            'total_danmu': total_danmu,
-            'total_gift': float_to_decimal(total_gift),
-            'total_superchat': float_to_decimal(total_superchat),
-            'total_reward':  float_to_decimal(total_reward),
-            'highlights': highlights,
-            'viewers': viewers,
-        })
-        await ClipInfo.create(**clip_info)
-        clip_info.pop('highlights')
-        logger.debug(f"Created: {clip_info}")
+    # 以下步骤都按库里的数据重新计算, 重复运行也没关系
+    if 0 < summary.total_danmakus and total_inserted < summary.total_danmakus:
+        # 有一部分弹幕之前已经写入过, 上面累加的统计不准, 按库里的弹幕重新算一遍
+        await refresh_clip(clip_id)
+    invalidate_clip(clip_id, uid)
+    await refresh_viewer_activity(clip_id)
+    await refresh_guard_ledger(clip_id)
+    await archive_clip(clip_id)
+    await refresh_channels(uid)
 
     # 输出一下
     start_t = live_start_time.strftime(r"%Y-%m-%d %H:%M:%S%z")
     end_t = end_time.strftime(r"%Y-%m-%d %H:%M:%S%z")
     logger.info(f"Update complete: ID={room_id} Start={start_t} End={end_t}")
+
+# 新建场次信息, 已经存在时把这一段的统计合并进去(弹幕密度按合并后的总弹幕数和新的起止时间重新算)
+# 小数位和float_to_decimal一样直接截断
+CLIP_INFO_MERGE_SQL = '''
+    INSERT INTO "clipinfo" (
+        "clip_id", "name", "bilibili_uid", "title", "start_time", "end_time", "cover",
+        "danmu_density", "total_danmu", "total_gift", "total_superchat", "total_reward", "highlights", "viewers"
+        )
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13::jsonb, $14)
+    ON CONFLICT ("clip_id") DO UPDATE SET
+        "name" = EXCLUDED."name",
+        "bilibili_uid" = EXCLUDED."bilibili_uid",
+        "title" = EXCLUDED."title",
+        "start_time" = EXCLUDED."start_time",
+        "end_time" = EXCLUDED."end_time",
+        "cover" = EXCLUDED."cover",
+        "danmu_density" = coalesce(trunc((
+            ("clipinfo"."total_danmu" + EXCLUDED."total_danmu")
+            / NULLIF(extract(epoch FROM EXCLUDED."end_time" - EXCLUDED."start_time") / 60, 0)
+            )::numeric, 3)::float8, 0),
+        "total_danmu" = "clipinfo"."total_danmu" + EXCLUDED."total_danmu",
+        "total_gift" = trunc(("clipinfo"."total_gift" + EXCLUDED."total_gift")::numeric, 2)::float8,
+        "total_superchat" = trunc(("clipinfo"."total_superchat" + EXCLUDED."total_superchat")::numeric, 2)::float8,
+        "total_reward" = trunc(("clipinfo"."total_reward" + EXCLUDED."total_reward")::numeric, 2)::float8,
+        "highlights" = CASE WHEN jsonb_typeof("clipinfo"."highlights") = 'array'
+            THEN "clipinfo"."highlights" || EXCLUDED."highlights" ELSE EXCLUDED."highlights" END,
+        "viewers" = EXCLUDED."viewers"
+    RETURNING (xmax <> 0) AS "merged"
+    '''
+
+async def __update_clip_info(danmakus_info:dict, username:str, uid:int, cover:str):
+    '新建场次信息, 已经存在时把这一段的统计合并进去(一条INSERT ... ON CONFLICT, 不会和并发写入互相覆盖)'
+    clip_id = danmakus_info['clip_id']
+    clip_info = {
+        'clip_id': clip_id,
+        'name': username,
+        'bilibili_uid': uid,
+        'title': danmakus_info['title'],
+        'start_time': danmakus_info['live_start_time'],
+        'end_time': danmakus_info['end_time'],
+        'cover': cover,
+        'danmu_density': float_to_decimal(danmakus_info['danmu_density'], 3),
+        'total_danmu': danmakus_info['total_danmakus'],
+        'total_gift': float_to_decimal(danmakus_info['total_gift']),
+        'total_superchat': float_to_decimal(danmakus_info['total_superchat']),
+        'total_reward':  float_to_decimal(danmakus_info['total_reward']),
+        'viewers': danmakus_info['viewers'],
+    }
+    values = list(clip_info.values())
+    values.insert(12, dumps(danmakus_info['highlights']).decode('utf-8'))
+    rows = await ClipInfo._meta.db.execute_query_dict(CLIP_INFO_MERGE_SQL, values)
+    logger.debug(f"{'Updated' if rows[0]['merged'] else 'Created'}: {clip_info}")
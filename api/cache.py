@@ -0,0 +1,50 @@
+'''序列化好的响应缓存(进程内LRU), 按场次ID+内容版本保存gzip压缩后的数据和ETag
+原始数据比压缩后大十倍左右, 不保存, 少数不支持gzip的客户端现场解压'''
+import gzip, hashlib
+
+from static import config
+
+__entries:dict[tuple, dict] = {} # (场次ID, 格式) -> {'version', 'etag', 'gzip_etag', 'gzip'}, 按最近使用排序
+
+def get(clip_id:str, version=None, fmt="json"):
+    '-> 缓存的响应, 没有缓存或版本不一致时返回None'
+    entry = __entries.get((clip_id, fmt))
+    if entry is None or entry['version'] != version:
+        return None
+    # 移到最后(最近使用)
+    __entries[(clip_id, fmt)] = __entries.pop((clip_id, fmt))
+    return entry
+
+def encode(body:bytes, version=None):
+    '''计算ETag并压缩 -> 缓存项
+    不碰缓存本身, 可以放到线程里跑, 再在事件循环里用put存入'''
+    digest = hashlib.md5(body).hexdigest()
+    return {
+        'version': version,
+        'etag': f'"{digest}"', # 强ETag, 内容相同时相同
+        'gzip_etag': f'"{digest}-gz"', # gzip压缩后是另一种表示, 强ETag不能和未压缩的相同
+        'gzip': gzip.compress(body, compresslevel=config.cache.get('gzip_level', 6)),
+    }
+
+def put(clip_id:str, entry:dict, fmt="json"):
+    '缓存encode得到的缓存项(每种格式分别缓存, 只在事件循环里调用) -> 缓存项'
+    size = config.cache.get('size', 64)
+    if size <= 0:
+        return entry
+    __entries.pop((clip_id, fmt), None)
+    __entries[(clip_id, fmt)] = entry
+    while len(__entries) > size:
+        del __entries[next(iter(__entries))]
+    return entry
+
+def invalidate(clip_id:str):
+    '场次内容有变动时删除缓存(所有格式)'
+    for key in [key for key in __entries if key[0] == clip_id]:
+        del __entries[key]
+
+def etag_matches(if_none_match:str, etag:str):
+    '请求头If-None-Match里是否包含当前的ETag'
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
@@ -0,0 +1,31 @@
+'JSON编解码(装了orjson/msgspec时优先使用, 没有的话用标准库), 以及可选的MessagePack编码(需要msgpack)'
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    try:
+        import msgspec
+    except ImportError:
+        msgspec = None
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+elif msgspec is not None:
+    loads = msgspec.json.decode
+    dumps = msgspec.json.encode
+else:
+    loads = json.loads
+    def dumps(obj) -> bytes:
+        '-> utf-8编码的JSON'
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# MessagePack(可选)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+packb = msgpack.packb if msgpack is not None else None
@@ -0,0 +1,145 @@
+'blrec事件的后台任务队列(存在数据库里, 服务重启后会继续处理)'
+import asyncio, datetime, traceback
+from loguru import logger
+
+from db import migrations
+from db.models import IngestJobs
+from static import config
+from . import blrec
+
+__workers:list[asyncio.Task] = []
+__wakeup:asyncio.Event = None
+
+def get_handler(event_type:str):
+    '事件类型 -> 处理函数'
+    return {
+        "RawDanmakuFileCompletedEvent": blrec.update_clip,
+    }[event_type]
+
+async def enqueue(data:dict):
+    '把webhook事件加进队列, 同一个事件只会加一次'
+    job, is_created = await IngestJobs.get_or_create(
+        event_id=data['id'],
+        defaults={
+            'event_type': data['type'],
+            'payload': {**data, 'id': str(data['id'])},
+            'run_after': datetime.datetime.now(datetime.timezone.utc),
+        }
+    )
+    if is_created:
+        logger.debug(f"Job queued: {job.id} {job.event_type}")
+    if __wakeup is not None:
+        __wakeup.set()
+    return job
+
+async def claim_job():
+    '''取出一个可以运行的任务并标记为running
+    用FOR UPDATE SKIP LOCKED, 多个worker同时取也不会拿到同一个任务'''
+    table = IngestJobs._meta.db_table
+    sql = f'''
+        UPDATE "{table}" SET "status" = 'running', "attempts" = "attempts" + 1, "started_at" = now()
+        WHERE "id" = (
+            SELECT "id" FROM "{table}"
+            WHERE "status" = 'pending' AND "run_after" <= now()
+            ORDER BY "id" LIMIT 1 FOR UPDATE SKIP LOCKED
+        )
+        RETURNING "id"
+        '''
+    rows = await IngestJobs._meta.db.execute_query_dict(sql)
+    if not rows:
+        return None
+    return await IngestJobs.get(id=rows[0]['id'])
+
+async def run_job(job:IngestJobs):
+    '运行单个任务, 失败时按指数退避重新排队, 超过最大次数后标记为failed'
+    max_attempts = config.queue.get('max_attempts', 5)
+    retry_delay = config.queue.get('retry_delay', 30)
+    try:
+        await get_handler(job.event_type)(job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if job.attempts < max_attempts:
+            delay = retry_delay * 2 ** (job.attempts - 1)
+            logger.warning(f"Job {job.id} failed ({job.attempts}/{max_attempts}), retrying in {delay}s")
+            await IngestJobs.filter(id=job.id).update(
+                status="pending", error=error, run_after=now + datetime.timedelta(seconds=delay)
+                )
+        else:
+            logger.error(f"Job {job.id} failed after {job.attempts} attempts: {error}")
+            await IngestJobs.filter(id=job.id).update(status="failed", error=error, finished_at=now)
+        return
+    await IngestJobs.filter(id=job.id).update(
+        status="done", error=None, finished_at=datetime.datetime.now(datetime.timezone.utc)
+        )
+    logger.debug(f"Job done: {job.id}")
+
+async def worker_loop():
+    '不断取任务运行, 队列空了就等新任务或者到下一次轮询(数据库升级完成前先等着)'
+    poll_interval = config.queue.get('poll_interval', 10)
+    await migrations.wait_content_hash_index() # 唯一索引建好之前写入会漏掉去重
+    while True:
+        try:
+            job = await claim_job()
+        except Exception:
+            logger.exception("Failed to claim job")
+            job = None
+        if job is not None:
+            try:
+                await run_job(job)
+            except Exception:
+                # 更新任务状态时出错, worker不能退出, 任务下次启动时重新排队
+                logger.exception(f"Failed to run job {job.id}")
+            continue
+        __wakeup.clear()
+        try:
+            await asyncio.wait_for(__wakeup.wait(), timeout=poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def start_workers():
+    '''启动worker(上次没跑完就退出的任务会重新排队)
+    已经用完重试次数的标记为failed, 不然把进程搞崩的任务(比如超大文件内存不够)每次启动都会再跑一遍'''
+    global __wakeup
+    __wakeup = asyncio.Event()
+    max_attempts = config.queue.get('max_attempts', 5)
+    failed = await IngestJobs.filter(status="running", attempts__gte=max_attempts).update(
+        status="failed", error="Interrupted (process exited while running)",
+        finished_at=datetime.datetime.now(datetime.timezone.utc)
+        )
+    if failed:
+        logger.error(f"{failed} interrupted jobs reached max attempts, marked as failed")
+    await IngestJobs.filter(status="running").update(status="pending")
+    workers = config.queue.get('workers', 2)
+    for _ in range(workers):
+        __workers.append(asyncio.create_task(worker_loop()))
+    logger.debug(f"Job workers started (Workers: {workers})")
+
+async def stop_workers():
+    '停止worker, 正在运行的任务下次启动时重新运行'
+    for task in __workers:
+        task.cancel()
+    await asyncio.gather(*__workers, return_exceptions=True)
+    __workers.clear()
+
+async def get_status(limit=20):
+    '队列状态: 排队数/运行中的任务/最近完成的任务及耗时'
+    now = datetime.datetime.now(datetime.timezone.utc)
+    running = await IngestJobs.filter(status="running").values(
+        'id', 'event_type', 'attempts', 'started_at'
+        )
+    for job in running:
+        job['elapsed'] = (now - job['started_at']).total_seconds()
+    finished = await IngestJobs.filter(status__in=["done", "failed"]).order_by('-finished_at').limit(limit).values(
+        'id', 'event_type', 'status', 'attempts', 'created_at', 'started_at', 'finished_at', 'error'
+        )
+    for job in finished:
+        job['duration'] = (job['finished_at'] - job['started_at']).total_seconds()
+        job['wait'] = (job['started_at'] - job['created_at']).total_seconds()
+    return {
+        'pending': await IngestJobs.filter(status="pending").count(),
+        'failed': await IngestJobs.filter(status="failed").count(),
+        'workers': len(__workers),
+        'running': running,
+        'finished': finished,
+    }
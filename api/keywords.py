@@ -0,0 +1,52 @@
+'高能关键词匹配'
+from functools import lru_cache
+from loguru import logger
+
+from static import config
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+    logger.debug("pyahocorasick not found, falling back to str.count")
+
+DEFAULT_KEYWORDS = ["草", "？", "哈", "好好好", "牛蛙", "wase", "call"] # 预定义关键词
+
+class KeywordMatcher:
+    '''多关键词匹配器, 编译一次之后对每段文本只扫描一遍
+    计数规则与str.count相同(同一个关键词的匹配互不重叠)'''
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+        if ahocorasick is None:
+            self.automaton = None
+            return
+        self.automaton = ahocorasick.Automaton()
+        for idx, key in enumerate(self.keywords):
+            self.automaton.add_word(key, (idx, len(key)))
+        self.automaton.make_automaton()
+
+    def count(self, text:str):
+        '-> 每个关键词在text里出现的次数'
+        if self.automaton is None:
+            return [text.count(key) for key in self.keywords]
+        counts = [0] * len(self.keywords)
+        last_end = [-1] * len(self.keywords)
+        for end, (idx, length) in self.automaton.iter(text):
+            # 同一个关键词的匹配按结束位置依次出现, 跳过与上一次匹配重叠的部分
+            if end - length >= last_end[idx]:
+                counts[idx] += 1
+                last_end[idx] = end
+        return counts
+
+@lru_cache(maxsize=64)
+def get_matcher(keywords:tuple):
+    '获取(缓存的)匹配器'
+    return KeywordMatcher(keywords)
+
+def get_keywords(uid=None):
+    '获取指定主播的高能关键词(默认关键词+该主播单独设置的关键词)'
+    keywords = list(config.highlight.get('keywords', DEFAULT_KEYWORDS))
+    for channel_config in config.highlight.get('channel', []):
+        if channel_config['uid'] == uid:
+            keywords.extend(k for k in channel_config['keywords'] if k not in keywords)
+    return tuple(keywords)
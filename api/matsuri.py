@@ -1,18 +1,95 @@
 '处理Matsuri API'
-import datetime, math
+import asyncio, datetime, heapq, math, time
+import numpy as np
 from loguru import logger
 from tortoise.exceptions import DoesNotExist
-from functools import reduce
+from functools import reduce, wraps
 
-from db.models import ClipInfo, Comments, OffComments, Subtitles, Channels
-#from ..static import config
+from db.models import ClipInfo, Comments, OffComments, Subtitles, Channels, ViewerClipActivity, GuardLedger, ClipArchive, GUARD_NAMES
+from db.migrations import VIEWER_ACTIVITY_SQL, GUARD_LEDGER_SQL
+from static import config
+from . import search, archive, cache
+from .codec import loads, dumps, packb
 from .parse import get_room_info, date_to_mili_timestamp, highlight_parse, float_to_decimal
 
+### 频道/场次信息缓存
+# 这部分数据只在收到blrec事件/手动刷新时才会变, 变动的地方都会主动清掉对应的缓存
+__metadata_cache:dict[tuple, tuple] = {} # (函数名, 参数) -> (过期时间, 返回值), 按最近使用排序
+__metadata_stats = {'hits': 0, 'misses': 0}
+
+def get_metadata(key:tuple):
+    '-> (是否命中, 缓存的值)'
+    cached = __metadata_cache.pop(key, None)
+    if cached is not None and cached[0] > time.monotonic():
+        __metadata_stats['hits'] += 1
+        __metadata_cache[key] = cached # 移到最后(最近使用)
+        return True, cached[1]
+    __metadata_stats['misses'] += 1
+    return False, None
+
+def put_metadata(key:tuple, value):
+    '缓存查询结果, 超过数量上限时删掉最久没用过的'
+    ttl = config.cache.get('metadata_ttl', 300)
+    if ttl <= 0:
+        return
+    __metadata_cache[key] = (time.monotonic() + ttl, value)
+    while len(__metadata_cache) > config.cache.get('metadata_size', 1024):
+        del __metadata_cache[next(iter(__metadata_cache))]
+
+def cached_metadata(func):
+    '缓存频道/场次信息的查询结果(有过期时间和数量上限), 参数统一转成字符串作为key'
+    @wraps(func)
+    async def wrapper(*args):
+        key = (func.__name__, tuple(str(arg) for arg in args))
+        is_hit, res = get_metadata(key)
+        if not is_hit:
+            res = await func(*args)
+            put_metadata(key, res)
+        return res
+    return wrapper
+
+def invalidate_metadata(func_name:str, *args):
+    '清掉func_name的缓存, 给了args时只清掉参数以args开头的'
+    prefix = tuple(str(arg) for arg in args)
+    for key in [k for k in __metadata_cache if k[0] == func_name and k[1][:len(prefix)] == prefix]:
+        del __metadata_cache[key]
+
+def invalidate_channel(uid=None):
+    '频道信息(频道列表/频道详情/场次列表)有变动时清掉缓存, uid为None时清掉所有频道的'
+    invalidate_metadata('get_channel_list')
+    if uid is None:
+        invalidate_metadata('get_channel_id')
+        invalidate_metadata('get_channel_id_clips')
+    else:
+        invalidate_metadata('get_channel_id', uid)
+        invalidate_metadata('get_channel_id_clips', uid)
+
+def invalidate_clip(clip_id, uid=None):
+    '场次信息有变动时清掉缓存(包括所属频道的场次列表)'
+    invalidate_metadata('get_clip_id', clip_id)
+    invalidate_metadata('get_clip_infos', clip_id)
+    if uid is not None:
+        invalidate_metadata('get_channel_id_clips', uid)
+
+def get_metadata_cache_stats():
+    '缓存命中情况'
+    return {
+        'size': len(__metadata_cache),
+        **__metadata_stats,
+    }
+
 ### Clip
 async def delete_clip(clip_id):
     '删除指定弹幕和场次'
-    await ClipInfo.get(clip_id=clip_id).delete()
+    clip_info = await ClipInfo.get(clip_id=clip_id)
+    await clip_info.delete()
     await Comments.filter(clip_id=clip_id).all().delete()
+    await ViewerClipActivity.filter(clip_id=clip_id).delete()
+    await GuardLedger.filter(clip_id=clip_id).delete()
+    await archive.delete(clip_id)
+    cache.invalidate(clip_id)
+    invalidate_clip(clip_id, clip_info.bilibili_uid)
+    await refresh_channels(clip_info.bilibili_uid)
     return {"code": 200}
 
 async def refresh_clip(clip_id):
@@ -34,7 +111,7 @@ async def refresh_clip(clip_id):
         ).all().order_by("time").values(
             'time', 'text'
             )
-    highlights = highlight_parse(plain_danmakus)
+    highlights = highlight_parse(plain_danmakus, uid=old_clip.bilibili_uid)
 
     # 开始时间
     first_danmaku = await Comments.filter(clip_id=clip_id).order_by("time").first()
@@ -44,14 +121,14 @@ async def refresh_clip(clip_id):
         start_time = old_clip.start_time
 
     # 收入统计
-    all_danmakus = await Comments.filter(clip_id=clip_id).all().values('gift_price', 'superchat_price')
+    all_danmakus = await Comments.filter(clip_id=clip_id).all().values('gift_price', 'gift_num', 'superchat_price')
     total_gift = 0
     total_superchat = 0
     for d in all_danmakus:
         gift_price = d['gift_price']
         sc_price = d['superchat_price']
         if gift_price:
-            total_gift += gift_price
+            total_gift += gift_price * (d['gift_num'] or 1) # gift_price是单价
         elif sc_price:
             total_superchat += sc_price
 
@@ -72,8 +149,10 @@ async def refresh_clip(clip_id):
         'highlights': highlights,
     }
     await ClipInfo.filter(clip_id=clip_id).update(**clip_info)
+    invalidate_clip(clip_id, old_clip.bilibili_uid)
     return {"code": 200}
 
+@cached_metadata
 async def get_clip_id(clip_id):
     '获取场次概览信息'
     clip_info = await ClipInfo.get_or_none(clip_id=clip_id)
@@ -108,40 +187,233 @@ async def get_clip_id(clip_id):
         'status': 0, 'data': data
     }
 
-async def get_clip_id_comments(clip_id):
-    '获取特定场次的所有弹幕'
-    # EXTRACT(EPOCH FROM "time")*1000 as time, username, user_id, superchat_price, 
-    # gift_name, gift_price, gift_num, "text" 
-    # FROM all_comments WHERE clip_id = $1 ORDER BY "time"', [id])
-    danmakus = await Comments.filter(clip_id=clip_id).all().values(
-        'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-        'gift_num', "text"
+async def get_clip_id_comments_json(clip_id):
+    '获取特定场次的所有弹幕 -> JSON数组(utf-8), 有归档时直接返回归档里序列化好的, 没有的话顺便生成一个'
+    danmakus_json = await archive.read_json(clip_id)
+    if danmakus_json is None:
+        danmakus_json, columns_json, total_items = await get_clip_danmakus_serialized(clip_id)
+        if total_items:
+            await archive.save(clip_id, danmakus_json, columns_json, total_items)
+    return danmakus_json
+
+# 场次的所有弹幕和字幕(按时间排序, 时间相同时弹幕在前), 直接在数据库里拼成JSON
+# data: 对象数组, 字段与/clip/{id}/comments的返回值一致: time为毫秒时间戳, superchat_price/gift_name为null时不返回
+# columns: 按列的数据(归档的格式, 见api.archive), 值为null的也保留
+CLIP_DANMAKUS_SQL = '''
+SELECT coalesce(json_agg(CASE
+        WHEN "superchat_price" IS NOT NULL AND "gift_name" IS NOT NULL THEN json_build_object({time}, {user}, 
+            'superchat_price', "superchat_price", 'gift_name', "gift_name", {rest})
+        WHEN "superchat_price" IS NOT NULL THEN json_build_object({time}, {user}, 
+            'superchat_price', "superchat_price", {rest})
+        WHEN "gift_name" IS NOT NULL THEN json_build_object({time}, {user}, 
+            'gift_name', "gift_name", {rest})
+        ELSE json_build_object({time}, {user}, {rest})
+        END ORDER BY "time", "src", "id"), '[]')::text AS "data",
+    json_build_object({column_aggs})::text AS "columns",
+    count(*) AS "total_items"
+FROM (
+    SELECT 0 AS "src", "id", {columns} FROM "comments" WHERE "clip_id" = $1
+    UNION ALL
+    SELECT 1 AS "src", "id", {columns} FROM "subtitles" WHERE "clip_id" = $1
+) AS d
+'''.format(
+    columns=', '.join(f'"{c}"' for c in archive.ARCHIVE_COLUMNS),
+    time=''''time', floor(extract(epoch FROM "time") * 1000)::bigint''',
+    user=''''username', "username", 'user_id', "user_id"''',
+    rest=''''gift_price', "gift_price", 'gift_num', "gift_num", 'text', "text"''',
+    column_aggs=', '.join(
+        f"""'{c}', coalesce(json_agg({'floor(extract(epoch FROM "time") * 1000)::bigint' if c == 'time' else f'"{c}"'} """
+        f"""ORDER BY "time", "src", "id"), '[]')"""
+        for c in archive.ARCHIVE_COLUMNS
+        ),
     )
-    subtitles = await Subtitles.filter(clip_id=clip_id).all().values(
-        'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-        'gift_num', "text"
-    )
-    danmakus.extend(subtitles)
-    # danmakus:list
-    danmakus.sort(key=lambda x:x['time'])
-
-    # 处理数据库返回的信息
-    for idx, danmaku in enumerate(danmakus):
-        # 把返回值可以null的部分去掉
-        for nullable_key in ['superchat_price', 'gift_name']:
-            if danmaku[nullable_key] is None:
-                danmakus[idx].pop(nullable_key)
-        # 把时间改成毫秒时间戳
-        danmakus[idx].update({
-            'time': date_to_mili_timestamp(danmaku['time'])
-        })
 
+async def get_clip_danmakus_serialized(clip_id):
+    '''场次的所有弹幕和字幕 -> (JSON数组, 按列数据的JSON, 条数), JSON都是utf-8
+    合并/排序/时间转换/序列化都在数据库里完成, 不用逐条处理'''
+    rows = await Comments._meta.db.execute_query_dict(CLIP_DANMAKUS_SQL, [clip_id])
+    row = rows[0]
+    return row['data'].encode('utf-8'), row['columns'].encode('utf-8'), row['total_items']
+
+CLIP_COMMENTS_FORMATS = ('json', 'columnar', 'msgpack') # /clip/{id}/comments支持的格式
+
+def encode_columnar(columns:dict):
+    '''归档的按列数据 -> 紧凑的按列格式(columnar/msgpack共用)
+    data里每个字段是一个与弹幕一一对应的数组, 值为null的也保留
+    time: 第一个为毫秒时间戳, 之后为与前一条的差值
+    username: usernames(用户名表)里的下标'''
+    usernames = {}
+    username_idx = [usernames.setdefault(name, len(usernames)) for name in columns['username']]
+    time_deltas = np.diff(np.array(columns['time'], dtype=np.int64), prepend=0).tolist()
     return {
-        'status': 0, 'data': danmakus
+        'status': 0,
+        'format': 'columnar',
+        'total': len(time_deltas),
+        'usernames': list(usernames),
+        'data': {
+            **columns,
+            'time': time_deltas,
+            'username': username_idx,
+        },
     }
 
+async def get_clip_id_columns(clip_id):
+    '获取特定场次的所有弹幕(按列), 没有归档时顺便生成一个'
+    columns = await archive.read_columns(clip_id)
+    if columns is None:
+        danmakus_json, columns_json, total_items = await get_clip_danmakus_serialized(clip_id)
+        if total_items:
+            await archive.save(clip_id, danmakus_json, columns_json, total_items)
+        columns = loads(columns_json)
+    return columns
+
+async def get_clip_id_comments_cached(clip_id, stream_threshold=0, fmt="json"):
+    '''获取特定场次的所有弹幕(序列化好的缓存项, 见api.cache)
+    以归档的更新时间作为内容版本, 别的进程更新了归档时也不会读到旧的缓存
+    fmt: json(对象数组)/columnar(按列的JSON, 见encode_columnar)/msgpack(按列的MessagePack)
+    json格式没有缓存和归档, 并且弹幕数不少于stream_threshold时返回None, 由调用方用stream_clip_id_comments流式返回'''
+    version = await ClipArchive.filter(clip_id=clip_id).first().values_list('updated_at', flat=True)
+    entry = cache.get(clip_id, version, fmt)
+    if entry is not None:
+        return entry
+    if fmt != "json":
+        columnar = encode_columnar(await get_clip_id_columns(clip_id))
+        body = packb(columnar) if fmt == "msgpack" else dumps(columnar)
+        if version is None:
+            # 刚刚生成了归档
+            version = await ClipArchive.filter(clip_id=clip_id).first().values_list('updated_at', flat=True)
+        return cache.put(clip_id, await asyncio.to_thread(cache.encode, body, version), fmt)
+    if version is None and stream_threshold > 0:
+        total_danmu = await ClipInfo.filter(clip_id=clip_id).first().values_list('total_danmu', flat=True)
+        if total_danmu is not None and total_danmu >= stream_threshold:
+            return None
+    # 归档里/数据库拼好的JSON直接拼进响应, 不用解析再序列化
+    body = b'{"status":0,"data":' + await get_clip_id_comments_json(clip_id) + b'}'
+    if version is None:
+        # 刚刚生成了归档
+        version = await ClipArchive.filter(clip_id=clip_id).first().values_list('updated_at', flat=True)
+    # 压缩比较慢, 放到线程里跑, 不阻塞其他请求; 存入缓存在事件循环里做, 不和get/invalidate同时改缓存
+    return cache.put(clip_id, await asyncio.to_thread(cache.encode, body, version))
+
+# 流式返回时整个下载过程都占着一个数据库连接和事务, 客户端慢的时候会占很久, 限制同时进行的数量
+__stream_slots = asyncio.Semaphore(max(config.cache.get('max_streams', 2), 1))
+__archive_tasks:dict[str, asyncio.Task] = {} # 场次ID -> 正在生成归档的任务
+
+async def stream_clip_id_comments(clip_id, chunk_size=1000):
+    '''边读边生成/clip/{id}/comments的JSON(与get_clip_id_comments_cached的返回值一致)
+    每chunk_size条弹幕输出一块, 内存占用与弹幕条数无关; 同时进行的数量超过max_streams时排队'''
+    async with __stream_slots:
+        yield b'{"status":0,"data":['
+        chunk = []
+        is_first = True
+        async for danmaku in iter_clip_danmakus(clip_id):
+            chunk.append(dumps(danmaku))
+            if len(chunk) >= chunk_size:
+                yield (b'' if is_first else b',') + b','.join(chunk)
+                chunk.clear()
+                is_first = False
+        if chunk:
+            yield (b'' if is_first else b',') + b','.join(chunk)
+        yield b']}'
+
+async def archive_clip(clip_id):
+    '重新生成场次的弹幕归档(入库/刷新场次/添加字幕之后调用)'
+    cache.invalidate(clip_id)
+    # 先确认会写归档再读弹幕, 整场读出来很慢
+    if not await archive.is_writable(clip_id):
+        return False
+    return await archive.save(clip_id, *await get_clip_danmakus_serialized(clip_id))
+
+async def ensure_clip_archive(clip_id):
+    '''场次还没有归档时生成归档(流式返回之后在后台调用)
+    同一场次同时只生成一次, 其他请求等待同一个任务; 已经有归档时直接跳过'''
+    async def build():
+        if await ClipArchive.exists(clip_id=clip_id):
+            return False
+        return await archive_clip(clip_id)
+    task = __archive_tasks.get(clip_id)
+    if task is None:
+        # 先登记再检查, 中间不能有await, 否则同时进来的请求都会各自生成一遍
+        task = asyncio.create_task(build())
+        __archive_tasks[clip_id] = task
+        task.add_done_callback(lambda _: __archive_tasks.pop(clip_id, None))
+    return await asyncio.shield(task)
+
+async def iter_clip_danmakus(clip_id, prefetch=2000):
+    '''按时间顺序逐条读取特定场次的弹幕和字幕
+    两张表各开一个服务端游标(按时间排序, 走clip_id_time索引), 再按时间归并, 不用整场读进内存排序
+    时间相同时弹幕排在字幕前面'''
+    columns = ', '.join(f'"{c}"' for c in archive.ARCHIVE_COLUMNS)
+    async with Comments._meta.db.acquire_connection() as raw_conn:
+        # 服务端游标只能在事务里使用
+        async with raw_conn.transaction():
+            cursors = [
+                raw_conn.cursor(
+                    f'SELECT {columns} FROM "{model._meta.db_table}" WHERE "clip_id" = $1 ORDER BY "time", "id"', 
+                    clip_id, prefetch=prefetch
+                    ).__aiter__()
+                for model in (Comments, Subtitles)
+            ]
+            heads = []
+            for idx, cursor in enumerate(cursors):
+                record = await anext(cursor, None)
+                if record is not None:
+                    heads.append((record['time'], idx, record))
+            heapq.heapify(heads)
+            while heads:
+                _, idx, record = heads[0]
+                danmaku = dict(record)
+                # 把返回值可以null的部分去掉
+                for nullable_key in archive.OPTIONAL_COLUMNS:
+                    if danmaku[nullable_key] is None:
+                        del danmaku[nullable_key]
+                # 把时间改成毫秒时间戳
+                danmaku['time'] = date_to_mili_timestamp(danmaku['time'])
+                yield danmaku
+                record = await anext(cursors[idx], None)
+                if record is None:
+                    heapq.heappop(heads)
+                else:
+                    heapq.heapreplace(heads, (record['time'], idx, record))
 
 ### Channel
+CHANNEL_STATS_SQL = '''
+    SELECT "bilibili_uid", count(*) AS "total_clips", sum("total_danmu") AS "total_danmu",
+        max("start_time") AS "last_live",
+        (array_agg("total_danmu" ORDER BY "start_time" DESC))[1] AS "last_danmu"
+    FROM "clipinfo" {where} GROUP BY "bilibili_uid"
+    ''' # 每个主播的场次数/总弹幕数/最近一场的开始时间和弹幕数
+
+async def refresh_channels(uid=None):
+    '''按场次信息重新统计直播间的场次数和弹幕数(用一条UPDATE批量完成)
+    uid为None时刷新所有直播间 -> 更新的直播间数'''
+    where = 'WHERE "bilibili_uid" = $1' if uid is not None else ''
+    sql = f'''
+        UPDATE "channels" AS c SET
+            "total_clips" = coalesce(s."total_clips", 0),
+            "total_danmu" = coalesce(s."total_danmu", 0),
+            "last_danmu" = coalesce(s."last_danmu", 0),
+            "last_live" = s."last_live"
+        FROM "channels" AS c2 LEFT JOIN ({CHANNEL_STATS_SQL.format(where=where)}) AS s
+            ON s."bilibili_uid" = c2."bilibili_uid"
+        WHERE c."bilibili_live_room" = c2."bilibili_live_room" {'AND c2."bilibili_uid" = $1' if where else ''}
+        RETURNING c."bilibili_live_room"
+        '''
+    count, _ = await Channels._meta.db.execute_query(sql, [uid] if where else None)
+    invalidate_channel(uid)
+    return count
+
+async def refresh_viewer_activity(clip_id):
+    '按库里的弹幕重新统计该场次每个观众的发言'
+    await ViewerClipActivity._meta.db.execute_query(VIEWER_ACTIVITY_SQL, [clip_id])
+
+async def refresh_guard_ledger(clip_id):
+    '把该场次新的大航海记录写进guard_ledger'
+    await GuardLedger._meta.db.execute_query(
+        GUARD_LEDGER_SQL.format(where='AND c."clip_id" = $1'), [clip_id]
+        )
+
+@cached_metadata
 async def get_channel_list():
     '获取频道列表'
     # SELECT name, bilibili_uid, bilibili_live_room, is_live, last_danmu, 
@@ -163,6 +435,7 @@ async def get_channel_list():
         'status': 0, 'data': channel_list
     }
 
+@cached_metadata
 async def get_channel_id(mid:int):
     '获取指定频道信息'
     # 'SELECT name, bilibili_uid, bilibili_live_room, is_live, last_danmu, total_clips, 
@@ -182,6 +455,7 @@ async def get_channel_id(mid:int):
         'status': 0, 'data': channel_info
     }
 
+@cached_metadata
 async def get_channel_id_clips(mid:int, page:int):
     '获取指定频道的所有场次'
     # SELECT id, bilibili_uid, title, EXTRACT(EPOCH FROM start_time)*1000 AS start_time, 
@@ -229,7 +503,7 @@ async def get_mid_date(mid:int, date:str):
     # [mid, format_date, format_date + 24 * 3600]
     t1 = datetime.datetime.strptime(date, r"%Y%m%d")
     t2 = t1 + datetime.timedelta(days=1)
-    danmakus = await OffComments.filter(liver_uid=mid, time__gte=t1, time___lte=t2).all().order_by("time")
+    danmakus = await OffComments.filter(liver_uid=mid, time__gte=t1, time__lte=t2).all().order_by("time")
     data = [{
         'time': date_to_mili_timestamp(danmaku.time),
         'username': danmaku.username,
@@ -248,84 +522,105 @@ async def get_mid_date(mid:int, date:str):
 ### Viewer
 async def get_search_advanced(data:dict):
     '高级搜索'
-    # 构建请求体
-    args = {
-        'text__contains': data['keyword']
-    }
-
     # 提取参数
+    filters = {
+        'keyword': data['keyword'],
+        'start_time': datetime.datetime.fromisoformat(data['startTime']) if data['startTime'] else None,
+        'end_time': datetime.datetime.fromisoformat(data['endTime']) if data['endTime'] else None,
+    }
     is_get_danmaku = data['type'] in ('all', 'danmaku')
     is_get_subtitle = data['type'] in ('all', 'subtitle')
-    if data['startTime']:
-        start_time = datetime.datetime.fromisoformat(data['startTime'])
-        args.update({'time__gt': start_time})
-    if data['endTime']:
-        end_time = datetime.datetime.fromisoformat(data['endTime'])
-        args.update({'time__lt': end_time})
     page = data['page'] if data['page'] > 0 else 1 # 与google的验证机制配合，只有获取第0页时需要校验
     page_size = data['pageSize']
-
-    # 查询总数
-    total_items = 0
+    models = []
     if is_get_danmaku:
-        total_items += await Comments.filter(**args).count()
+        models.append(Comments)
     if is_get_subtitle:
-        total_items += await Subtitles.filter(**args).count()
+        models.append(Subtitles)
+
+    # 查询总数(有缓存, 结果很多时为估计值)
+    total_items = 0
+    approximate = False
+    for model in models:
+        count, is_approximate = await search.cached_count(model, **filters)
+        total_items += count
+        approximate = approximate or is_approximate
     total_pages = math.ceil(total_items/page_size)
 
     # 查询具体内容
-    danmakus_list = []
-    if is_get_danmaku:
-        danmakus_list.extend(
-            await Comments.filter(
-                **args
-            ).all().order_by('-time').offset(page_size*(page-1)).limit(page_size).values(
-                'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-                'gift_num', 'text', 'clip_id'
-            )
+    danmakus_list, next_cursor = await search.search_tables(
+        models, cursor=data.get('cursor'), offset=page_size*(page-1), limit=page_size, **filters
         ) # Page要-1，因为前端是从1开始算的
-    if is_get_subtitle:
-        danmakus_list.extend(
-            await Subtitles.filter(
-                **args
-            ).all().order_by('-time').offset(page_size*(page-1)).limit(page_size).values(
-                'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-                'gift_num', 'text', 'clip_id'
-            )
-        )
 
     return await (__get_final_list(
-        danmakus_list, version=2, page=page, total_pages=total_pages, total_items=total_items
+        danmakus_list, version=2, page=page, total_pages=total_pages, total_items=total_items, 
+        next_cursor=next_cursor, approximate=approximate
         ))
 
-async def get_search_danmaku(danmaku:str, page:int):
+async def get_search_danmaku(danmaku:str, page:int, cursor:str=None):
     '弹幕全局搜索'
-    danmakus_list = await Comments.filter(
-        text__contains=danmaku
-    ).all().order_by('-time').offset(30*(page-1)).limit(30).values(
-        'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-        'gift_num', 'text', 'clip_id'
-    )
+    danmakus_list, next_cursor = await search.search_tables(
+        [Comments], cursor=cursor, offset=30*(page-1), limit=30, keyword=danmaku
+        )
     # Page要-1，因为前端是从1开始算的
-    return await (__get_final_list(danmakus_list))
+    return await (__get_final_list(danmakus_list, next_cursor=next_cursor))
 
-async def get_viewer_mid(mid:int, page:int):
+async def get_viewer_mid(mid:int, page:int, cursor:str=None):
     '获取指定用户的发言'
     # SELECT DISTINCT(clip_id),MAX(time) as time FROM comments 
     # WHERE user_id = $1 GROUP BY clip_id ORDER BY "time" DESC LIMIT 10 OFFSET $2
     # danmakus_info = await Comments.filter(user_id=mid).group_by('clip_id').order_by('time').only('clip_id').distinct().offset(10*page).limit(10).values('clip_id')
     # 太复杂了，直接取100条吧
-    danmakus_info_list = await Comments.filter(
-        user_id=mid
-    ).all().order_by('-time').offset(50*(page-1)).limit(50).values(
-        'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-        'gift_num', 'text', 'clip_id'
-    )
+    danmakus_info_list, next_cursor = await search.search_tables(
+        [Comments], cursor=cursor, offset=50*(page-1), limit=50, user_id=mid
+        )
+    return (await __get_final_list(danmakus_info_list, next_cursor=next_cursor))
+
+async def get_viewer_clips(mid:int, page:int, page_size:int=50):
+    '''获取指定用户发言过的所有场次(按最后发言时间倒序), 附带每场的发言统计
+    具体发言用get_viewer_clip_comments按场次再取'''
+    page = page if page > 0 else 1
+    total_items = await ViewerClipActivity.filter(user_id=mid).count()
+    activities = await ViewerClipActivity.filter(user_id=mid).order_by('-last_time').offset(
+        page_size*(page-1)).limit(page_size).values(
+        'clip_id', 'username', 'first_time', 'last_time', 'total_danmu', 'total_gift', 'total_superchat'
+        )
+    clip_infos = await get_clip_infos([a['clip_id'] for a in activities])
+
+    final_list = []
+    for activity in activities:
+        clip_info = clip_infos.get(activity.pop('clip_id'))
+        if clip_info is None:
+            continue
+        activity.update({
+            'first_time': date_to_mili_timestamp(activity['first_time']),
+            'last_time': date_to_mili_timestamp(activity['last_time']),
+        })
+        final_list.append({
+            'clip_info': clip_info,
+            'activity': activity,
+        })
+    return {
+        'success': True,
+        'message': '',
+        'pagination': {
+            'totalItems': total_items,
+            'totalPages': math.ceil(total_items/page_size),
+            'currentPage': page,
+        },
+        'data': final_list
+    }
+
+async def get_viewer_clip_comments(mid:int, clip_id:str):
+    '获取指定用户在指定场次的所有发言'
+    danmakus_info_list = await Comments.filter(user_id=mid, clip_id=clip_id).order_by('time').values(
+        *search.SEARCH_COLUMNS
+        )
     return (await __get_final_list(danmakus_info_list))
 
-async def get_guard(mid:int, page:int, page_size:int):
-    '获取指定频道的所有场次'
-    # 暂时禁止单次请求5项以上
+async def get_guard(mid:int, page:int, page_size:int, cursor:str=None):
+    '获取指定用户的大航海记录(按时间倒序)'
+    # 禁止单次请求50项以上
     return_dict = {
         'status': 0, 
         'success': True,
@@ -337,77 +632,118 @@ async def get_guard(mid:int, page:int, page_size:int):
             'currentPage': 1,
         },
     }
-    if page_size > 5 or page > 1:
+    if page_size > 50 or page_size < 1:
         return return_dict
+    page = page if page > 0 else 1
 
     # 请求数量
-    args = dict(user_id=mid, gift_name__in=['总督', '提督', '舰长'])
-    total_items = await Comments.filter(**args).count()
-    # total_pages = math.ceil(total_items/page_size)
-    total_pages = 1
-
-    # 请求具体弹幕
-    danmakus_info_list = await Comments.filter(
-        **args
-    ).all().order_by('-time').offset(page_size*(page-1)).limit(page_size).values(
-        'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price', 
-        'gift_num', 'text', 'clip_id'
-    )
+    total_items = await GuardLedger.filter(user_id=mid).count()
+    total_pages = math.ceil(total_items/page_size)
+
+    # 请求具体记录
+    danmakus_info_list, next_cursor = await search.search_tables(
+        [GuardLedger], cursor=cursor, offset=page_size*(page-1), limit=page_size, user_id=mid
+        )
+    for item in danmakus_info_list:
+        item['text'] = item['gift_name'] # 与弹幕表里的大航海记录保持一致
     return (await __get_final_list(
-        danmakus_info_list, version=2, page=page, total_items=total_items, total_pages=total_pages
+        danmakus_info_list, version=2, page=page, total_items=total_items, total_pages=total_pages, 
+        next_cursor=next_cursor
         ))
 
-async def __get_final_list(danmakus_info_list, version=1, page=0, total_pages=0, total_items=0):
-    '统一处理返回值'
-    # 排序
-    danmakus_info_list_sorted = sorted(danmakus_info_list, key=lambda x:-x['time'].timestamp())
+async def get_guard_summary(mid:int):
+    '获取指定用户在每个主播那里的大航海统计(首次/最近一次上舰, 总月数, 总金额, 最高等级)'
+    # 先按主播汇总再取名字, 同一个主播有多个直播间(换过房间号)时不会重复计算
+    sql = f'''
+        SELECT g.*, c."name" FROM (
+            SELECT "liver_uid", min("time") AS "first_time", max("time") AS "last_time",
+                count(*) AS "total_purchases", sum("gift_num") AS "total_months",
+                sum("gift_price" * "gift_num") AS "total_price",
+                min(array_position(ARRAY[{', '.join(f"'{name}'" for name in GUARD_NAMES)}], "gift_name")) AS "top_level"
+            FROM "guard_ledger" WHERE "user_id" = $1 GROUP BY "liver_uid"
+        ) AS g LEFT JOIN LATERAL (
+            SELECT "name" FROM "channels" WHERE "bilibili_uid" = g."liver_uid"
+            ORDER BY "last_live" DESC NULLS LAST LIMIT 1
+        ) AS c ON TRUE
+        ORDER BY g."last_time" DESC
+        '''
+    summary_list = await GuardLedger._meta.db.execute_query_dict(sql, [mid])
+    for item in summary_list:
+        item.update({
+            'first_time': date_to_mili_timestamp(item['first_time']),
+            'last_time': date_to_mili_timestamp(item['last_time']),
+            'top_guard': GUARD_NAMES[item.pop('top_level') - 1],
+        })
+    return {
+        'status': 0, 'data': summary_list
+    }
+
+CLIP_INFO_COLUMNS = (
+    'name', 'clip_id', 'bilibili_uid', 'start_time', 'title', 'cover', 'danmu_density', 'end_time', 
+    'total_danmu', 'total_gift', 'total_reward', 'total_superchat', 'viewers'
+    ) # 搜索结果里附带的场次信息
+
+def __format_clip_info(clip_info:dict):
+    '场次信息 -> 前端用的格式'
+    clip_info.update({
+        'id': clip_info['clip_id'],
+        'start_time': date_to_mili_timestamp(clip_info['start_time']),
+        'end_time': date_to_mili_timestamp(clip_info['end_time']),
+        'views': clip_info['viewers'],
+    })
+    clip_info.pop('clip_id')
+    clip_info.pop('viewers')
+    return clip_info
+
+async def get_clip_infos(clip_ids):
+    '''批量获取场次信息(前端用的格式), 没缓存的场次用一条clip_id__in查询
+    -> {场次ID: 场次信息}, 不存在的场次不包含在内'''
+    clip_infos = {}
+    missing = []
+    for clip_id in clip_ids:
+        is_hit, clip_info = get_metadata(('get_clip_infos', (str(clip_id),)))
+        if not is_hit:
+            missing.append(clip_id)
+        elif clip_info is not None:
+            clip_infos[clip_id] = clip_info
+    if missing:
+        found = {
+            c['clip_id']: c for c in await ClipInfo.filter(clip_id__in=missing).values(*CLIP_INFO_COLUMNS)
+        }
+        for clip_id in missing:
+            clip_info = found.get(clip_id)
+            if clip_info is not None:
+                clip_info = __format_clip_info(clip_info)
+                clip_infos[clip_id] = clip_info
+            put_metadata(('get_clip_infos', (str(clip_id),)), clip_info)
+    return clip_infos
+
+async def __get_final_list(danmakus_info_list, version=1, page=0, total_pages=0, total_items=0, next_cursor=None, approximate=False):
+    '''统一处理返回值
+    next_cursor: 下一页的cursor, 没有下一页时为None
+    approximate: total_items是不是估计值'''
+    # 按时间倒序排序, 时间一次性换成毫秒时间戳
+    times = np.fromiter(
+        (item['time'].timestamp() for item in danmakus_info_list), dtype=np.float64, count=len(danmakus_info_list)
+        )
+    order = np.argsort(-times, kind='stable')
+    timestamps = (times * 1000).astype(np.int64).tolist()
 
-    # 建立dict
+    # 按场次分组(保持时间顺序)
     danmakus_dict = {}
-    for item in danmakus_info_list_sorted:
-        clip_id = item.get('clip_id', None)
-        clip_item = danmakus_dict.get(clip_id, None)
-        if clip_item:
-            danmakus_dict[clip_id].append(item)
-        else:
-            danmakus_dict.setdefault(clip_id, [item])
-    
-    # 获取场次信息
-    # logger.warning(f"{danmakus_dict}")
+    for idx in order.tolist():
+        item = danmakus_info_list[idx]
+        item['time'] = timestamps[idx]
+        danmakus_dict.setdefault(item.get('clip_id', None), []).append(item)
+
+    # 获取场次信息(一次查询)
+    clip_infos = await get_clip_infos(list(danmakus_dict.keys()))
     final_list = []
-    for clip_id in danmakus_dict.keys():
-        # SELECT id, bilibili_uid, EXTRACT(EPOCH FROM start_time)*1000 AS start_time, 
-        # title, cover, danmu_density, EXTRACT(EPOCH FROM end_time)*1000 AS end_time, 
-        # total_danmu, total_gift, total_reward, total_superchat, viewers AS views 
-        # FROM clip_info WHERE id = $1', [clip_id]
-        clip_info = await ClipInfo.get_or_none(clip_id=clip_id).values(
-            'name', 'clip_id', 'bilibili_uid', 'start_time', 'title', 'cover', 'danmu_density', 'end_time', 'total_danmu', 'total_gift', 'total_reward', 'total_superchat', 'viewers'
-            )
+    for clip_id, full_comments in danmakus_dict.items():
+        clip_info = clip_infos.get(clip_id)
         if not clip_info:
             logger.warning(f"No such clip_id: {clip_id}")
             continue
-
-        # SELECT name FROM channels WHERE bilibili_uid = $1
-        clip_info.update({
-            'id': clip_info['clip_id'],
-            'start_time': date_to_mili_timestamp(clip_info['start_time']),
-            'end_time': date_to_mili_timestamp(clip_info['end_time']),
-            'views': clip_info['viewers'],
-        })
-        clip_info.pop('clip_id')
-        clip_info.pop('viewers')
-
-        # SELECT EXTRACT(EPOCH FROM "time")*1000 as time, username, user_id, 
-        # superchat_price, gift_name, gift_price, gift_num, "text" FROM comments 
-        # WHERE clip_id = $1 AND user_id = $2 ORDER BY "time"
-        full_comments = danmakus_dict[clip_id]
-        if not full_comments:
-            logger.warning(f"Clip ID {clip_id} not found.")
-        for idx, c in enumerate(full_comments):
-            full_comments[idx]['time'] = date_to_mili_timestamp(c['time'])
-            # full_comments.append(c)
-
-        # 最终返回值
         final_list.append({
             'clip_info': clip_info, 
             'full_comments': full_comments
@@ -416,7 +752,7 @@ async def __get_final_list(danmakus_info_list, version=1, page=0, total_pages=0,
     # 返回值
     if version == 1:
         return {
-            'status': 0, 'data': final_list
+            'status': 0, 'data': final_list, 'nextCursor': next_cursor
         }
     elif version == 2:
         return {
@@ -427,6 +763,8 @@ async def __get_final_list(danmakus_info_list, version=1, page=0, total_pages=0,
                 'totalItems': total_items,
                 'totalPages': total_pages,
                 'currentPage': page,
+                'nextCursor': next_cursor,
+                'approximate': approximate,
             },
             'data': final_list
         }
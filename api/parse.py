@@ -1,9 +1,17 @@
-import datetime, json, os, re, uuid
+import asyncio, datetime, hashlib, math, os, re, sys, uuid
+from array import array
 import xml.etree.ElementTree as ET
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from aiohttp import ClientSession
 from loguru import logger
-from db.models import ClipInfo, Comments
+from db.writer import COMMENT_COLUMNS
 from static import config
+from .codec import loads
+from .keywords import get_keywords, get_matcher
+
+__pool:ProcessPoolExecutor = None
+TZ_CST = datetime.timezone(datetime.timedelta(seconds=28800))
 
 def float_to_decimal(num:float, decimal=2):
     '浮点数保留小数'
@@ -30,7 +38,7 @@ def timestamp_to_date(timestamp, ms=True):
     '1743566521395(毫秒) -> 2025-04-02 12:02:01'
     return datetime.datetime.fromtimestamp(
         timestamp / 1000 if ms else timestamp, 
-        tz=datetime.timezone(datetime.timedelta(seconds=28800))
+        tz=TZ_CST
         )
 
 def date_to_mili_timestamp(t:datetime.datetime):
@@ -43,6 +51,13 @@ def get_uuid(room_id:int, start_time:datetime.datetime):
     '通过房间号和开播时间计算uuid'
     return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{room_id}{start_time}"))
 
+def content_hash(clip_id:str, time:int, user_id:int, kind:int, text:str, gift_name, n:int):
+    '''弹幕内容的哈希(md5转uuid), 用于写入时去重
+    n: 同一场次里完全相同的弹幕(比如同一秒连送的礼物)是第几条, 从0开始
+    计算方法要与db.migrations里回填用的SQL保持一致'''
+    key = "\x1f".join((clip_id, str(time), str(user_id), str(kind), text or "", gift_name or "", str(n)))
+    return uuid.UUID(bytes=hashlib.md5(key.encode()).digest())
+
 async def get_room_info(room_id):
     '从blrec获取房间信息'
     host = config.app['blrec_url']
@@ -75,145 +90,357 @@ async def get_cookies():
 
     return cookies_dict
 
-def xml_get(patt, s):
-    '用于xml字段的正则表达式匹配'
-    pattern = re.compile(f"(?<=\<{patt}\>).*(?=\<\/{patt}\>)")
-    res = re.search(pattern, s)
-    if res:
-        return res.group()
-    else:
-        logger.error(f"no result for {patt} in {s}")
-        return None
-
-def xmlonly_parse(file_content:str, clip_id:str, record_start_time:datetime.datetime):
-    '只有xml文件时用这个解析'
-    summary = {
-        "danmakus": [],
-        "all_danmakus": [],
-        "plain_danmakus": [], # 供分析高能词用
-        "total_danmakus": 0,
-        "total_superchat": 0,
-        "total_reward":  0,
-        "total_gift": 0,
-        "viewers": 0,
-        "last_danmaku": None,
-    }
-
-    # 开始解析
-    if type(file_content) is list:
-        file_content = "\n".join(file_content)
-    root = ET.fromstring(file_content)
-    info = {}
+def xml_get(patt, metadata:dict):
+    '从xml文件头里取出字段'
+    res = metadata.get(patt, None)
+    if res is None:
+        logger.error(f"no result for {patt} in {metadata}")
+    return res
 
-    # 普通弹幕
-    for d in root.findall('d'):
-        # 时间
-        p = d.get('p')
+def xml_elem_parse(elem:ET.Element, batch:"DanmakuBatch", record_start_ts:int):
+    '把xml里的单个弹幕/礼物/SC/大航海元素加进batch, 是其他元素时返回False'
+    if elem.tag == 'd':
+        # 普通弹幕
+        p = elem.get('p')
         relative_ts = p[:p.find(',')] # 取出p属性的第一个元素
-        final_time = relative_ts_to_time(relative_ts, record_start_time)
-        info = {
-            "clip_id": clip_id,
-            "time": final_time,
-            "username": d.get('user'),
-            "user_id": int(d.get('uid')),
-            "medal_name": None, # 无法从xml里获取
-            "medal_level": None,
-            "guard_level": None,
-            "text": d.text,
-            "superchat_price": None,
-            "gift_name": None,
-            "gift_price": 0,
-            "gift_num": 0,
-            "is_misc": False
-        }
-        summary["danmakus"].append(Comments(**info))
-        summary["plain_danmakus"].append(info)
-
-    # 礼物
-    for gift in root.findall('gift'):
-        info = {
-            "clip_id": clip_id,
-            "time": relative_ts_to_time(gift.get('ts'), record_start_time),
-            "username": gift.get('user'),
-            "user_id": int(gift.get('uid')),
-            "medal_name": None,
-            "medal_level": None,
-            "guard_level": None,
-            "text": gift.get('giftname'),
-            "gift_price": int(gift.get('price')) / 1000,
-            "gift_num": int(gift.get('giftcount')),
-            "gift_name": gift.get('giftname')
-        }
-        total_price = info['gift_price'] * info['gift_num']
-        summary["danmakus"].append(Comments(**info))
-        summary['total_gift'] += total_price
-        summary['total_reward'] += total_price
-
-    # SC
-    for sc in root.findall('sc'):
-        info = {
-            "clip_id": clip_id,
-            "time": relative_ts_to_time(sc.get('ts'), record_start_time),
-            "username": sc.get('user'),
-            "user_id": int(sc.get('uid')),
-            "medal_name": None,
-            "medal_level": None,
-            "guard_level": None,
-            "text": sc.text,
-            "superchat_price": int(sc.get('price')) / 1000,
-        }
-        total_price = info['superchat_price']
-        summary["danmakus"].append(Comments(**info))
-        summary['total_reward'] += total_price
-        summary['total_superchat'] += total_price
-
-    # 大航海
-    for toast in root.findall('toast'):
-        info = {
-            "clip_id": clip_id,
-            "time": relative_ts_to_time(toast.get('ts'), record_start_time),
-            "username": toast.get('user'),
-            "user_id": int(toast.get('uid')),
-            "text": toast.get('role'),
-            "gift_price": int(toast.get('price')) / 1000,
-            "gift_num": int(toast.get('count')),
-            "gift_name": toast.get('role')
+        batch.append(
+            DanmakuBatch.PLAIN, 
+            time=record_start_ts + round(float(relative_ts)*1000), 
+            username=elem.get('user'), 
+            user_id=int(elem.get('uid')), 
+            text=elem.text, # 粉丝牌无法从xml里获取
+            gift_price=0, 
+            gift_num=0, 
+        )
+    elif elem.tag == 'gift':
+        # 礼物
+        batch.append(
+            DanmakuBatch.GIFT, 
+            time=record_start_ts + round(float(elem.get('ts'))*1000), 
+            username=elem.get('user'), 
+            user_id=int(elem.get('uid')), 
+            text=elem.get('giftname'), 
+            gift_name=elem.get('giftname'), 
+            gift_price=int(elem.get('price')) / 1000, 
+            gift_num=int(elem.get('giftcount')), 
+        )
+    elif elem.tag == 'sc':
+        # SC
+        batch.append(
+            DanmakuBatch.SUPERCHAT, 
+            time=record_start_ts + round(float(elem.get('ts'))*1000), 
+            username=elem.get('user'), 
+            user_id=int(elem.get('uid')), 
+            text=elem.text, 
+            superchat_price=int(elem.get('price')) / 1000, 
+        )
+    elif elem.tag == 'toast':
+        # 大航海
+        batch.append(
+            DanmakuBatch.GIFT, 
+            time=record_start_ts + round(float(elem.get('ts'))*1000), 
+            username=elem.get('user'), 
+            user_id=int(elem.get('uid')), 
+            text=elem.get('role'), 
+            guard_level=0, 
+            gift_name=elem.get('role'), 
+            gift_price=int(elem.get('price')) / 1000, 
+            gift_num=int(elem.get('count')), 
+        )
+    else:
+        return False
+    return True
+
+class HighlightCounter:
+    '''分段统计高能关键词, 只保存每个分段的计数, 内存占用与弹幕条数无关
+    内部按resolution(毫秒)的细粒度分段保存, 输出时可以合并成任意整数倍的窗口
+    start_ts: 分段的起点(毫秒时间戳, 一般是录制开始时间), 不指定时用第一批弹幕里最早的时间;
+    分批统计时要指定, 否则后面的批次里有更早的弹幕(SC/大航海的时间不一定按顺序)时分段会对不齐'''
+    def __init__(self, window=None, uid=None, start_ts=None):
+        self.keywords = get_keywords(uid)
+        if window is None:
+            window = config.highlight.get('window', 60) * 1000
+        self.window = window
+        self.resolution = math.gcd(window, 10000) # 至少能合并出10s/30s/60s
+        self.start_ts = start_ts
+        self.first_idx = 0
+        self.counts = np.zeros((0, len(self.keywords)), dtype=np.int64)
+
+    def add_batch(self, ts, texts:list):
+        '统计一批弹幕, ts为毫秒时间戳数组, texts为对应的弹幕内容'
+        if len(ts) == 0:
+            return
+        ts = np.asarray(ts, dtype=np.int64)
+        if self.start_ts is None:
+            self.start_ts = int(ts.min())
+
+        # 排序后用searchsorted找出每个分段的边界
+        order = np.argsort(ts, kind='stable')
+        sorted_ts = ts[order]
+        first = int((sorted_ts[0] - self.start_ts) // self.resolution)
+        last = int((sorted_ts[-1] - self.start_ts) // self.resolution)
+        edges = self.start_ts + np.arange(first, last+2, dtype=np.int64) * self.resolution
+        bounds = np.searchsorted(sorted_ts, edges).tolist()
+
+        # 每个分段的弹幕用\0拼在一起再数关键词(不会跨弹幕匹配, 所以分段怎么合并都不影响结果)
+        sorted_texts = [texts[i] or "" for i in order.tolist()]
+        matcher = get_matcher(self.keywords)
+        counts = np.zeros((last-first+1, len(self.keywords)), dtype=np.int64)
+        for row in range(last-first+1):
+            start, end = bounds[row], bounds[row+1]
+            if start == end:
+                continue
+            danmakus_seg = "\0".join(sorted_texts[start:end])
+            counts[row] = matcher.count(danmakus_seg)
+        self.__merge(first, counts)
+
+    def __merge(self, first:int, counts:np.ndarray):
+        '把一批分段计数合并进总计数, 必要时扩展范围'
+        if len(self.counts) == 0:
+            self.first_idx, self.counts = first, counts
+            return
+        lo = min(self.first_idx, first)
+        hi = max(self.first_idx + len(self.counts), first + len(counts))
+        if lo != self.first_idx or hi != self.first_idx + len(self.counts):
+            merged = np.zeros((hi-lo, len(self.keywords)), dtype=np.int64)
+            merged[self.first_idx-lo:self.first_idx-lo+len(self.counts)] = self.counts
+            self.first_idx, self.counts = lo, merged
+        self.counts[first-lo:first-lo+len(counts)] += counts
+
+    def result(self, window=None):
+        '-> [{关键词: 次数, ..., "time": 分段开始时间}], 没有弹幕的分段也保留'
+        if len(self.counts) == 0:
+            return []
+        window = window or self.window
+        if window % self.resolution != 0:
+            raise ValueError(f"Window {window}ms is not a multiple of {self.resolution}ms")
+
+        # 合并成需要的窗口大小
+        factor = window // self.resolution
+        group_idx = np.floor_divide(np.arange(self.first_idx, self.first_idx+len(self.counts)), factor)
+        group_start = int(group_idx[0])
+        group_counts = np.zeros((group_idx[-1]-group_start+1, len(self.keywords)), dtype=np.int64)
+        np.add.at(group_counts, group_idx-group_start, self.counts)
+
+        return [
+            dict(list(zip(self.keywords, counts)) + [('time', self.start_ts + window*(group_start+row))])
+            for row, counts in enumerate(group_counts.tolist())
+        ]
+
+class DanmakuBatch:
+    '''一批同一场次的弹幕, 按列存储
+    时间(毫秒时间戳)/用户ID/价格等放在array里, 可以为空的整数用-1表示空, 价格用NaN表示空
+    用户名/粉丝牌/礼物名称做字符串驻留, 只在真正需要时才转换成dict'''
+    PLAIN, GIFT, SUPERCHAT = 0, 1, 2 # 普通弹幕/礼物和大航海/SC
+
+    def __init__(self, clip_id:str):
+        self.clip_id = clip_id
+        self.kinds = array('b')
+        self.times = array('q')
+        self.user_ids = array('q')
+        self.usernames = []
+        self.texts = []
+        self.medal_names = []
+        self.medal_levels = array('h')
+        self.guard_levels = array('h')
+        self.superchat_prices = array('d')
+        self.gift_names = []
+        self.gift_prices = array('d')
+        self.gift_nums = array('i')
+        self.is_misc = array('b')
+        self.hashes = [] # 内容哈希, 由DanmakuSummary.add_batch填入
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, kind:int, time:int, username:str, user_id:int, text:str, 
+               medal_name=None, medal_level=None, guard_level=None, superchat_price=None, 
+               gift_name=None, gift_price=None, gift_num=None, is_misc=False):
+        '添加一条弹幕, 没给的字段跟数据库的默认值一致'
+        self.kinds.append(kind)
+        self.times.append(time)
+        self.user_ids.append(user_id)
+        self.usernames.append(sys.intern(username))
+        self.texts.append(text)
+        self.medal_names.append(sys.intern(medal_name) if medal_name else medal_name)
+        self.medal_levels.append(-1 if medal_level is None else medal_level)
+        self.guard_levels.append(-1 if guard_level is None else guard_level)
+        self.superchat_prices.append(math.nan if superchat_price is None else superchat_price)
+        self.gift_names.append(sys.intern(gift_name) if gift_name else gift_name)
+        self.gift_prices.append(math.nan if gift_price is None else gift_price)
+        self.gift_nums.append(-1 if gift_num is None else gift_num)
+        self.is_misc.append(is_misc)
+
+    def record(self, idx:int):
+        '-> 第idx条弹幕的tuple(字段顺序与COMMENT_COLUMNS一致)'
+        superchat_price = self.superchat_prices[idx]
+        gift_price = self.gift_prices[idx]
+        return (
+            self.clip_id,
+            timestamp_to_date(self.times[idx]),
+            self.usernames[idx],
+            self.user_ids[idx],
+            self.medal_names[idx],
+            None if self.medal_levels[idx] < 0 else self.medal_levels[idx],
+            None if self.guard_levels[idx] < 0 else self.guard_levels[idx],
+            self.texts[idx],
+            None if math.isnan(superchat_price) else superchat_price,
+            self.gift_names[idx],
+            None if math.isnan(gift_price) else gift_price,
+            None if self.gift_nums[idx] < 0 else self.gift_nums[idx],
+            bool(self.is_misc[idx]),
+        )
+
+    def records(self, with_hash=False):
+        '''-> 所有弹幕的tuple列表, 可以直接交给bulk_insert
+        with_hash: 末尾附上内容哈希(字段顺序与HASHED_COMMENT_COLUMNS一致)'''
+        if with_hash:
+            return [self.record(idx) + (self.hashes[idx],) for idx in range(len(self))]
+        return [self.record(idx) for idx in range(len(self))]
+
+    def kind_of(self, idx:int):
+        '按入库后的字段判断弹幕类型(与数据库里能还原出来的一致)'
+        if not math.isnan(self.superchat_prices[idx]):
+            return self.SUPERCHAT
+        if self.gift_names[idx] is not None:
+            return self.GIFT
+        return self.PLAIN
+
+    def content_hashes(self, seen:dict):
+        '''计算每条弹幕的内容哈希
+        seen: 已经出现过的弹幕 -> 出现次数, 跨批次保留, 用来区分完全相同的弹幕'''
+        hashes = []
+        for idx in range(len(self)):
+            key = (self.times[idx], self.user_ids[idx], self.kind_of(idx), self.texts[idx], self.gift_names[idx])
+            n = seen.get(key, 0)
+            seen[key] = n + 1
+            hashes.append(content_hash(self.clip_id, *key, n))
+        if len(seen) > 10000 and len(self) > 0:
+            # 时间相差很远的弹幕不可能完全相同, 清掉旧的
+            min_time = max(self.times) - 60000
+            for key in [k for k in seen if k[0] < min_time]:
+                del seen[key]
+        return hashes
+
+    def row(self, idx:int):
+        '-> 第idx条弹幕的dict(字段与Comments一致)'
+        return dict(zip(COMMENT_COLUMNS, self.record(idx)))
+
+class DanmakuSummary:
+    '''弹幕文件的累计统计, 每解析完一批就更新一次
+    start_ts: 录制开始时间(毫秒时间戳), 高能关键词从这里开始分段'''
+    def __init__(self, uid=None, start_ts=None):
+        self.total_danmakus = 0
+        self.total_superchat = 0
+        self.total_reward = 0
+        self.total_gift = 0
+        self.viewers = 0
+        self.last_danmaku = {}
+        self.highlight = HighlightCounter(uid=uid, start_ts=start_ts)
+        self.seen = {} # 计算内容哈希用, 见DanmakuBatch.content_hashes
+
+    def add_batch(self, batch:DanmakuBatch):
+        '统计一批弹幕/礼物/SC/大航海'
+        if len(batch) == 0:
+            return
+        self.total_danmakus += len(batch)
+        self.last_danmaku = batch.row(len(batch)-1)
+        batch.hashes = batch.content_hashes(self.seen)
+        kinds = np.frombuffer(batch.kinds, dtype=np.int8)
+
+        # SC
+        superchat_prices = np.frombuffer(batch.superchat_prices)[kinds == DanmakuBatch.SUPERCHAT]
+        total_price = math.fsum(superchat_prices.tolist())
+        self.total_reward += total_price
+        self.total_superchat += total_price
+
+        # 礼物和大航海
+        is_gift = kinds == DanmakuBatch.GIFT
+        gift_prices = np.frombuffer(batch.gift_prices)[is_gift]
+        gift_nums = np.frombuffer(batch.gift_nums, dtype=np.int32)[is_gift]
+        total_price = math.fsum((gift_prices * gift_nums).tolist())
+        self.total_gift += total_price
+        self.total_reward += total_price
+
+        # 普通弹幕, 供分析高能词用
+        plain_idx = np.flatnonzero(kinds == DanmakuBatch.PLAIN)
+        self.highlight.add_batch(
+            np.frombuffer(batch.times, dtype=np.int64)[plain_idx], 
+            [batch.texts[i] for i in plain_idx.tolist()]
+            )
+
+    def to_dict(self):
+        '最终结果'
+        return {
+            "total_danmakus": self.total_danmakus,
+            "total_superchat": self.total_superchat,
+            "total_reward": int(self.total_reward*10) / 10,
+            "total_gift": int(self.total_gift*10) / 10,
+            "viewers": self.viewers,
+            "last_danmaku": self.last_danmaku,
+            "highlights": self.highlight.result(),
         }
-        total_price = info['gift_num'] * info['gift_price']
-        summary["danmakus"].append(Comments(**info))
-        summary['total_gift'] += total_price
-        summary['total_reward'] += total_price
-
-    # 最后
-    summary['total_gift'] = int(summary['total_gift']*10) / 10
-    summary['total_reward'] = int(summary['total_reward']*10) / 10
-    summary['total_danmakus'] = len(summary['danmakus'])
-    summary['last_danmaku'] = info
-    return summary
-
-def jsonl_parse(file_content, clip_id):
-    summary = {
-        "danmakus": [],
-        "all_danmakus": [],
-        "plain_danmakus": [], # 供分析高能词用
-        "total_danmakus": 0,
-        "total_superchat": 0,
-        "total_reward":  0,
-        "total_gift": 0,
-        "viewers": 0,
-        "last_danmaku": None,
-    }
 
-    info = {}
+def xmlonly_parse(file_content, batch:DanmakuBatch, record_start_time:datetime.datetime, is_resumed=False):
+    '''只有xml文件时用这个解析(生成器, 逐行增量解析, 处理完的元素随即清除)
+    弹幕直接加进batch, 每读完不含半截元素的若干行就产出一次, 此时可以安全地中断
+    is_resumed: 从文件中间开始读(没有根元素)时设为True'''
+    record_start_ts = date_to_mili_timestamp(record_start_time)
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    if is_resumed:
+        parser.feed(b'<i>')
+    root = None
+    depth = 0
+    is_added = False
     for line in file_content:
+        parser.feed(line)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                # 只处理根元素下面的一层
+                continue
+            is_added = xml_elem_parse(elem, batch, record_start_ts) or is_added
+        if depth <= 1:
+            # 当前没有读了一半的元素
+            if root is not None:
+                root.clear()
+            if is_added:
+                yield
+                is_added = False
+
+JSONL_CMDS = {b"DANMU_MSG", b"SEND_GIFT", b"SUPER_CHAT_MESSAGE", b"USER_TOAST_MSG", b"WATCHED_CHANGE"} # 需要处理的cmd
+
+CMD_PATTERN = re.compile(rb'\{"cmd":\s*"([^"]*)"')
+
+def peek_cmd(line:bytes):
+    '''不解析整行, 直接从开头取出cmd的值
+    只认{"cmd": "..."开头的行, 取不出来时返回None'''
+    res = CMD_PATTERN.match(line)
+    if res:
+        return res.group(1)
+    return None
+
+def jsonl_parse(file_content, batch:DanmakuBatch, summary:DanmakuSummary):
+    '解析原始弹幕文件(生成器, 逐行读取, 弹幕直接加进batch, 每加一条产出一次)'
+    for line in file_content:
+        # 先用cmd粗筛一遍, 不需要的行就不完整解析了
+        cmd = peek_cmd(line) if type(line) is bytes else None
+        if cmd is not None and cmd not in JSONL_CMDS:
+            continue
         try:
-            js = json.loads(line)
+            js = loads(line)
         except Exception:
             raise Exception(f"Parse Error on {line}")
         cmd = js['cmd']
         if cmd == "WATCHED_CHANGE":
             # 已观看人数更新
-            summary['viewers'] = js['data']['num']
+            summary.viewers = js['data']['num']
+            continue
         # elif cmd == "INTERACT_WORD":
         #     # 进入房间
         #     if not js['data']['fans_medal']:
@@ -221,18 +448,17 @@ def jsonl_parse(file_content, clip_id):
         #     else:
         #         fans_medal = js['data']['fans_medal']
         #     uname = js['data']['uname']
-        #     info = {
-        #         "clip_id": clip_id,
-        #         "time": timestamp_to_date(js['data']['timestamp'], ms=False),
-        #         "username": uname,
-        #         "user_id": js['data']['uid'],
-        #         "medal_name": fans_medal['medal_name'],
-        #         "medal_level": fans_medal['medal_level'],
-        #         "guard_level": fans_medal['guard_level'],
-        #         "text": f"{uname}进入直播间",
-        #         "is_misc": True
-        #     }
-        #     summary["danmakus"].append(Comments(**info))
+        #     batch.append(
+        #         DanmakuBatch.PLAIN, 
+        #         time=js['data']['timestamp'] * 1000, 
+        #         username=uname, 
+        #         user_id=js['data']['uid'], 
+        #         medal_name=fans_medal['medal_name'], 
+        #         medal_level=fans_medal['medal_level'], 
+        #         guard_level=fans_medal['guard_level'], 
+        #         text=f"{uname}进入直播间", 
+        #         is_misc=True, 
+        #     )
         elif cmd == "DANMU_MSG":
             # 普通弹幕
             if not js.get("info", None):
@@ -246,103 +472,93 @@ def jsonl_parse(file_content, clip_id):
                 guard_level = medal_guard_info[10]
             else:
                 medal_name = medal_level = guard_level = None
-            info = {
-                "clip_id": clip_id,
-                "time": timestamp_to_date(js['info'][0][4]),
-                "username": js['info'][2][1],
-                "user_id": js['info'][2][0],
-                "medal_name": medal_name,
-                "medal_level": medal_level,
-                "guard_level": guard_level,
-                "text": js['info'][1],
-                "superchat_price": None,
-                "gift_name": None,
-                "gift_price": 0,
-                "gift_num": 0,
-                "is_misc": False
-            } # 有superchat_price和gift_name中的任何一项, 都会被视为礼物弹幕
-            summary["danmakus"].append(Comments(**info))
-            summary["plain_danmakus"].append(info)
+            batch.append(
+                DanmakuBatch.PLAIN, 
+                time=js['info'][0][4], 
+                username=js['info'][2][1], 
+                user_id=js['info'][2][0], 
+                medal_name=medal_name, 
+                medal_level=medal_level, 
+                guard_level=guard_level, 
+                text=js['info'][1], 
+                gift_price=0, 
+                gift_num=0, 
+            ) # 有superchat_price和gift_name中的任何一项, 都会被视为礼物弹幕
         elif cmd == "SEND_GIFT":
             # 投喂礼物
-            info = {
-                "clip_id": clip_id,
-                "time": timestamp_to_date(js['data']['timestamp'], ms=False),
-                "username": js['data']['uname'],
-                "user_id": js['data']['uid'],
-                "medal_name": js['data']['medal_info']['medal_name'],
-                "medal_level": js['data']['medal_info']['medal_level'],
-                "guard_level": js['data']['medal_info']['guard_level'],
-                "text": js['data']['giftName'],
-                "gift_price": js['data']['total_coin'] / 1000,
-                "gift_num": 1, # 已经按实际收入算了就不要js['data']['num']了
-                "gift_name": js['data']['giftName']
-            }
-            total_price = info['gift_price'] # total_coin是实际收入，跟数量无关
-            summary["danmakus"].append(Comments(**info))
-            summary['total_gift'] += total_price
-            summary['total_reward'] += total_price
+            batch.append(
+                DanmakuBatch.GIFT, 
+                time=js['data']['timestamp'] * 1000, 
+                username=js['data']['uname'], 
+                user_id=js['data']['uid'], 
+                medal_name=js['data']['medal_info']['medal_name'], 
+                medal_level=js['data']['medal_info']['medal_level'], 
+                guard_level=js['data']['medal_info']['guard_level'], 
+                text=js['data']['giftName'], 
+                gift_name=js['data']['giftName'], 
+                gift_price=js['data']['total_coin'] / 1000, # total_coin是实际收入，跟数量无关
+                gift_num=1, # 已经按实际收入算了就不要js['data']['num']了
+            )
         elif cmd == "SUPER_CHAT_MESSAGE":
             # SC
-            info = {
-                "clip_id": clip_id,
-                "time": timestamp_to_date(js['send_time']),
-                "username": js['data']['user_info']['uname'],
-                "user_id": js['data']['uid'],
-                "medal_name": js['data']['medal_info']['medal_name'],
-                "medal_level": js['data']['medal_info']['medal_level'],
-                "guard_level": js['data']['medal_info']['guard_level'],
-                "text": js['data']['message'],
-                "superchat_price": js['data']['price'],
-            }
-            total_price = info['superchat_price']
-            summary["danmakus"].append(Comments(**info))
-            summary['total_reward'] += total_price
-            summary['total_superchat'] += total_price
+            batch.append(
+                DanmakuBatch.SUPERCHAT, 
+                time=js['send_time'], 
+                username=js['data']['user_info']['uname'], 
+                user_id=js['data']['uid'], 
+                medal_name=js['data']['medal_info']['medal_name'], 
+                medal_level=js['data']['medal_info']['medal_level'], 
+                guard_level=js['data']['medal_info']['guard_level'], 
+                text=js['data']['message'], 
+                superchat_price=js['data']['price'], 
+            )
         elif cmd == "USER_TOAST_MSG":
             # 大航海
-            info = {
-                "clip_id": clip_id,
-                "time": timestamp_to_date(js['data']['start_time'], ms=False),
-                "username": js['data']['username'],
-                "user_id": js['data']['uid'],
-                "text": js['data']['role_name'],
-                "gift_price": js['data']['price'] * js['data']['num'] / 1000,
-                "gift_num": 1,
-                "gift_name": js['data']['role_name']
-            }
-            total_price = info['gift_num'] * info['gift_price']
-            summary["danmakus"].append(Comments(**info))
-            summary['total_gift'] += total_price
-            summary['total_reward'] += total_price
-    # 最后
-    summary['total_gift'] = int(summary['total_gift']*10) / 10
-    summary['total_reward'] = int(summary['total_reward']*10) / 10
-    summary['total_danmakus'] = len(summary['danmakus'])
-    summary['last_danmaku'] = info
-    return summary
+            batch.append(
+                DanmakuBatch.GIFT, 
+                time=js['data']['start_time'] * 1000, 
+                username=js['data']['username'], 
+                user_id=js['data']['uid'], 
+                text=js['data']['role_name'], 
+                guard_level=0, 
+                gift_name=js['data']['role_name'], 
+                gift_price=js['data']['price'] / 1000, # 和xml的toast一样存单价, 数量(月数)放gift_num
+                gift_num=js['data']['num'], 
+            )
+        else:
+            continue
+        yield
 
 def xml_parse(file_content):
-    '从xml文件中提取信息'
-    file_content = str(file_content)
+    '从xml文件头中提取信息(读到metadata结束为止, 文件内容可以不完整)'
+    if type(file_content) is not str:
+        file_content = "".join(file_content)
+    parser = ET.XMLPullParser(events=('end',))
+    parser.feed(file_content)
+    metadata = {}
+    for _, elem in parser.read_events():
+        if elem.tag == 'metadata':
+            break
+        metadata[elem.tag] = elem.text
+
     # 开始时间
-    record_start_time = xml_get("record_start_time", file_content)
+    record_start_time = xml_get("record_start_time", metadata)
     record_start_time = date2_to_time(record_start_time)
-    live_start_time = xml_get("live_start_time", file_content)
+    live_start_time = xml_get("live_start_time", metadata)
     live_start_time = date2_to_time(live_start_time)
 
     # 直播间号
-    room_id = xml_get("room_id", file_content)
+    room_id = xml_get("room_id", metadata)
     room_id = int(room_id)
 
     # Clip ID
     clip_id = get_uuid(room_id, live_start_time)
 
     # 主鳖的名字
-    liver_name = xml_get("user_name", file_content)
+    liver_name = xml_get("user_name", metadata)
 
     # 直播间标题
-    title = xml_get("room_title", file_content)
+    title = xml_get("room_title", metadata)
 
     return {
         'clip_id': clip_id,
@@ -353,45 +569,17 @@ def xml_parse(file_content):
         'live_start_time': live_start_time
         }
 
-def highlight_parse(plain_danmakus_list:list):
-    '从弹幕列表中提取高能关键词(暂时只支持"草""？""哈哈"和应援词)'
+def highlight_parse(plain_danmakus_list:list, window=None, uid=None):
+    '从弹幕列表中提取高能关键词(默认为"草""？""哈哈"和应援词, 可以在设置里给每个主播单独添加)'
     if not plain_danmakus_list:
         return []
-    # 排个序
-    plain_danmakus_list.sort(key=lambda x:x['time'])
-
-    # 预定义关键词
-    keywords = ["草", "？", "哈", "好好好", "牛蛙", "wase", "call"]
-
-    # 确定如何对时间进行分段
-    start_ts = date_to_mili_timestamp(plain_danmakus_list[0]['time'])
-    summary_list = []
-
-    # 将弹幕文字内容进行分段
-    # seg_num = len(summary_list)
-    danmakus_seg_list = []
-    seg_idx = 0
-    while plain_danmakus_list:
-        seg_start_ts = start_ts + 60000*seg_idx
-        end_ts = 60000 + seg_start_ts
-        # logger.debug(f"current: {seg_start_ts}, end: {end_ts}")
-        danmakus_seg = ""
-        current_ts = date_to_mili_timestamp(plain_danmakus_list[0]['time'])
-        while current_ts < end_ts and len(plain_danmakus_list) > 0:
-            current_danmaku = plain_danmakus_list.pop(0)
-            danmakus_seg += current_danmaku['text']
-            current_ts = date_to_mili_timestamp(current_danmaku['time'])
-
-        # 发现超过了60秒后
-        danmakus_seg_list.append(danmakus_seg)
-        summary_list.append(dict([(key, 0) for key in keywords] + [('time', seg_start_ts)]))
-        seg_idx += 1
-
-    # 识别关键词个数
-    for idx, danmakus_seg in enumerate(danmakus_seg_list):
-        for key in keywords:
-            summary_list[idx][key] = danmakus_seg.count(key)
-    return summary_list
+    ts = np.fromiter(
+        (date_to_mili_timestamp(d['time']) for d in plain_danmakus_list), 
+        dtype=np.int64, count=len(plain_danmakus_list)
+        )
+    counter = HighlightCounter(window=window, uid=uid)
+    counter.add_batch(ts, [d['text'] for d in plain_danmakus_list])
+    return counter.result()
 
 def subtitles_parse(filename):
     '(Deprecated)解析自动语音识别的字幕'
@@ -403,12 +591,8 @@ def subtitles_parse(filename):
     pattern = re.compile(r"(\d+)\n(\d+:\d+:\d+,\d+) --> (\d+:\d+:\d+,\d+)\n(.+?)\n\n")
     matches = re.findall(pattern, file_content)
 
-def get_danmakus_info(data):
-    '从原始弹幕文件结束的webhook信息和具体文件中提取信息'
-    # data = kwargs['data']
-    # danmakus_only = kwargs.get('danmakus_only', False)
-    # subtitles_only = kwargs.get('subtitles_only', False)
-
+def read_danmakus_header(data):
+    '从原始弹幕文件结束的webhook信息和xml文件头中提取场次信息'
     # webhook消息
     jsonl_path = data['data']['path']
     end_time = date1_to_time(data['date'])
@@ -417,35 +601,78 @@ def get_danmakus_info(data):
     xml_path = f"{os.path.splitext(jsonl_path)[0]}.xml"
     logger.debug(f"Reading {xml_path}")
     with open(xml_path, "r", encoding='utf-8') as f:
-        file_content = f.readlines()
-    xml_summary = xml_parse(file_content)
-
-    # jsonl
-    clip_id = xml_summary['clip_id']
-    if os.path.exists(jsonl_path):
-        with open(jsonl_path, 'r', encoding='utf-8') as f:
-            file_content = f.readlines()
-        summary = jsonl_parse(file_content=file_content, clip_id=clip_id)
+        xml_summary = xml_parse(f.read(2000))
+
+    return {
+        **xml_summary,
+        'jsonl_path': jsonl_path,
+        'xml_path': xml_path,
+        'end_time': end_time,
+    }
+
+def parse_chunk(header:dict, summary:DanmakuSummary, offset:int, batch_size:int):
+    '''从offset处开始读取至多batch_size条弹幕, 可以在进程池里运行
+    -> (DanmakuBatch, 更新后的summary, 下一次读取的offset), 读完时offset为None'''
+    batch = DanmakuBatch(header['clip_id'])
+    next_offset = None
+    if os.path.exists(header['jsonl_path']):
+        with open(header['jsonl_path'], 'rb') as f:
+            f.seek(offset)
+            for _ in jsonl_parse(file_content=iter(f.readline, b''), batch=batch, summary=summary):
+                if len(batch) >= batch_size:
+                    next_offset = f.tell()
+                    break
     else:
-        summary = xmlonly_parse(file_content=file_content, clip_id=clip_id, record_start_time=xml_summary['record_start_time'])
+        with open(header['xml_path'], 'rb') as f:
+            f.seek(offset)
+            danmakus = xmlonly_parse(
+                file_content=iter(f.readline, b''), batch=batch, 
+                record_start_time=header['record_start_time'], is_resumed=offset > 0
+                )
+            for _ in danmakus:
+                if len(batch) >= batch_size:
+                    next_offset = f.tell()
+                    break
+    summary.add_batch(batch)
+    return batch, summary, next_offset
+
+def init_pool():
+    '初始化解析弹幕文件用的进程池'
+    global __pool
+    workers = config.parse.get('workers', 2)
+    __pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    logger.debug(f"Parse pool started (Workers: {workers})")
+
+def close_pool():
+    '关闭进程池'
+    if __pool is not None:
+        __pool.shutdown(cancel_futures=True)
+
+async def run_in_pool(func, *args):
+    '在进程池里运行解析函数, 不阻塞事件循环(workers为0时直接在当前进程运行)'
+    if __pool is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(__pool, func, *args)
+
+def finish_danmakus_info(header:dict, summary:DanmakuSummary):
+    '弹幕全部读完之后, 汇总场次信息'
+    summary = summary.to_dict()
 
     # 计算时间和弹幕频率（条/分钟）
-    start_time:datetime.datetime = xml_summary['record_start_time']
+    start_time:datetime.datetime = header['record_start_time']
+    end_time = header['end_time']
     if summary['last_danmaku'] != {}:
         end_time = summary['last_danmaku']['time']
     clip_time = end_time - start_time
     danmu_density = summary['total_danmakus'] / (clip_time.total_seconds()/60)
     danmu_density = int(danmu_density*100) / 100
 
-    # 识别高能词
-    highlights = highlight_parse(summary['plain_danmakus'])
-
     # 最终结果
     res = {
         **summary,
-        **xml_summary,
+        **header,
         'end_time': end_time,
         'danmu_density': danmu_density,
-        'highlights': highlights
     }
     return res
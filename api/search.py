@@ -0,0 +1,185 @@
+'弹幕/字幕搜索'
+import base64, binascii, datetime, time
+from tortoise.models import Model
+
+from static import config
+from .codec import loads, dumps
+
+SEARCH_COLUMNS = (
+    'time', 'username', 'user_id', 'superchat_price', 'gift_name', 'gift_price',
+    'gift_num', 'text', 'clip_id'
+    ) # 搜索结果返回的字段
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+__count_cache:dict[tuple, tuple] = {} # (表名, 搜索条件) -> (过期时间, 总数, 是否为估计值)
+
+class InvalidCursor(ValueError):
+    'cursor格式不对'
+
+def keyword_grams(keyword:str):
+    '''搜索词 -> 需要同时出现的单字/双字(与数据库里的danmaku_grams对应)
+    一个字的搜索词直接查单字, 否则查所有相邻两字'''
+    if len(keyword) == 1:
+        return [keyword]
+    return sorted({keyword[i:i+2] for i in range(len(keyword) - 1)})
+
+def encode_cursor(positions:dict):
+    '''每张表读到的位置{表名: (time, id)或None} -> 翻页用的cursor(不透明的字符串)
+    所有表都读完了的时候返回None'''
+    if all(position is None for position in positions.values()):
+        return None
+    data = {
+        table: None if position is None else [(position[0] - EPOCH) // MICROSECOND, position[1]]
+        for table, position in positions.items()
+    }
+    return base64.urlsafe_b64encode(dumps(data)).decode().rstrip("=")
+
+def decode_cursor(cursor:str):
+    'cursor -> {表名: (time, id)或None}, 格式不对时抛出InvalidCursor'
+    try:
+        data = loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return {
+            table: None if position is None else (
+                EPOCH + int(position[0]) * MICROSECOND, int(position[1])
+                )
+            for table, position in data.items()
+        }
+    except (binascii.Error, ValueError, TypeError, KeyError, IndexError, AttributeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+
+def build_where(keyword:str=None, start_time:datetime.datetime=None, end_time:datetime.datetime=None,
+                user_id:int=None, gift_names:list=None, after:tuple=None):
+    '''组合关键词/时间范围/用户/礼物/翻页位置条件 -> (WHERE子句, 参数)
+    关键词先用倒排索引(danmaku_grams)筛出候选, 再用strpos精确匹配(不用LIKE, 省得转义%和_)
+    具体先走倒排索引还是时间索引交给PostgreSQL按统计信息决定
+    after: 上一页最后一条的(time, id), 只取排在它后面的'''
+    conditions = []
+    params = []
+    if keyword:
+        params.append(keyword_grams(keyword))
+        conditions.append(f'danmaku_grams("text") @> ${len(params)}::text[]')
+        params.append(keyword)
+        conditions.append(f'strpos("text", ${len(params)}) > 0')
+    if start_time is not None:
+        params.append(start_time)
+        conditions.append(f'"time" > ${len(params)}')
+    if end_time is not None:
+        params.append(end_time)
+        conditions.append(f'"time" < ${len(params)}')
+    if user_id is not None:
+        params.append(user_id)
+        conditions.append(f'"user_id" = ${len(params)}')
+    if gift_names is not None:
+        # 直接写成常量, 这样才能用上只包含这几种礼物的部分索引
+        names = ', '.join("'{}'".format(name.replace("'", "''")) for name in gift_names)
+        conditions.append(f'"gift_name" IN ({names})')
+    if after is not None:
+        # 单独写一遍time的条件, 这样只有time的索引也能直接定位
+        params.extend(after)
+        conditions.append(f'"time" <= ${len(params)-1} AND ("time", "id") < (${len(params)-1}, ${len(params)})')
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+async def search(model:type[Model], offset=0, limit=30, **filters):
+    '''在指定的表里搜索(需要有id和time字段), 按时间倒序, 条件见build_where
+    -> (结果, 最后一条的位置), 已经没有下一页时位置为None'''
+    where, params = build_where(**filters)
+    # 表里没有的字段(比如大航海记录里的text)返回null
+    columns = ', '.join(
+        f'"{c}"' if c in model._meta.db_fields else f'NULL AS "{c}"' for c in SEARCH_COLUMNS
+        )
+    params.extend([offset, limit])
+    sql = f'''
+        SELECT "id", {columns} FROM "{model._meta.db_table}" {where}
+        ORDER BY "time" DESC, "id" DESC OFFSET ${len(params)-1} LIMIT ${len(params)}
+        '''
+    rows = await model._meta.db.execute_query_dict(sql, params)
+    position = (rows[-1]['time'], rows[-1]['id']) if len(rows) == limit else None
+    for row in rows:
+        row.pop('id')
+    return rows, position
+
+async def search_tables(models:list, cursor:str=None, offset=0, limit=30, **filters):
+    '''在几张表里分别搜索(每张表各取一页)
+    给了cursor时从cursor的位置接着往后取(与翻页深度无关), 否则按offset翻页
+    -> (所有结果, 下一页的cursor)'''
+    positions = decode_cursor(cursor) if cursor else None
+    results = []
+    next_positions = {}
+    for model in models:
+        table = model._meta.db_table
+        if positions is not None:
+            if positions.get(table) is None:
+                # 这张表已经读完了
+                next_positions[table] = None
+                continue
+            rows, next_positions[table] = await search(
+                model, limit=limit, after=positions[table], **filters
+                )
+        else:
+            rows, next_positions[table] = await search(model, offset=offset, limit=limit, **filters)
+        results.extend(rows)
+    return results, encode_cursor(next_positions)
+
+async def count(model:type[Model], **filters):
+    '搜索结果总数'
+    where, params = build_where(**filters)
+    sql = f'SELECT count(*) AS "count" FROM "{model._meta.db_table}" {where}'
+    rows = await model._meta.db.execute_query_dict(sql, params)
+    return rows[0]['count']
+
+async def estimate(model:type[Model], **filters):
+    '用EXPLAIN取查询计划里估计的结果行数(不实际执行查询)'
+    where, params = build_where(**filters)
+    sql = f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{model._meta.db_table}" {where}'
+    rows = await model._meta.db.execute_query_dict(sql, params)
+    plan = rows[0]['QUERY PLAN']
+    if isinstance(plan, str):
+        plan = loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def cache_key(model:type[Model], **filters):
+    '(表名, 搜索条件) -> 缓存用的key, 时间统一换成UTC, 同一个时刻的不同写法算同一个搜索条件'
+    items = []
+    for name, value in sorted(filters.items()):
+        if value is None:
+            continue
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        elif isinstance(value, (list, tuple)):
+            value = tuple(value)
+        items.append((name, value))
+    return (model._meta.db_table, tuple(items))
+
+async def cached_count(model:type[Model], **filters):
+    '''搜索结果总数, 同样的搜索条件在count_cache_ttl秒内只数一次
+    估计结果数超过approximate_count_threshold时不精确计数, 直接用估计值
+    -> (总数, 是否为估计值)'''
+    ttl = config.search.get('count_cache_ttl', 300)
+    size = config.search.get('count_cache_size', 1024)
+    threshold = config.search.get('approximate_count_threshold', 100000)
+    key = cache_key(model, **filters)
+    now = time.monotonic()
+    cached = __count_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1], cached[2]
+
+    approximate = False
+    total = None
+    if threshold > 0:
+        total = await estimate(model, **filters)
+        approximate = total > threshold
+    if not approximate:
+        total = await count(model, **filters)
+
+    if ttl > 0:
+        __count_cache.pop(key, None)
+        __count_cache[key] = (now + ttl, total, approximate)
+        if len(__count_cache) > size:
+            # 先清掉过期的, 还是太多的话从最早加进来的开始删
+            for expired_key in [k for k, v in __count_cache.items() if v[0] <= now]:
+                del __count_cache[expired_key]
+            while len(__count_cache) > size:
+                del __count_cache[next(iter(__count_cache))]
+    return total, approximate
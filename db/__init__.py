@@ -3,6 +3,7 @@ from tortoise import Tortoise
 from static import config
 from urllib.parse import quote
 from .models import *
+from . import migrations, partitions
 
 async def init_db():
     '初始化数据库'
@@ -24,6 +25,7 @@ async def init_db():
         }
     await Tortoise.init(config_db)
     await Tortoise.generate_schemas(safe=True)
+    await migrations.upgrade()
 
 async def close():
     '关闭数据库连接'
@@ -0,0 +1,42 @@
+'查询/修改表结构用的辅助函数'
+from loguru import logger
+
+async def is_partitioned(conn, table:str):
+    '表是不是分区表'
+    rows = await conn.execute_query_dict(
+        'SELECT "relkind"::text AS "relkind" FROM "pg_class" WHERE "oid" = to_regclass($1)', [table]
+        )
+    return bool(rows) and rows[0]['relkind'] == 'p'
+
+async def get_partitions(conn, table:str):
+    '-> [(分区名, 分区范围)]'
+    rows = await conn.execute_query_dict(
+        'SELECT c."relname", pg_get_expr(c."relpartbound", c."oid") AS "bound" '
+        'FROM "pg_inherits" AS i JOIN "pg_class" AS c ON c."oid" = i."inhrelid" '
+        'WHERE i."inhparent" = to_regclass($1) ORDER BY c."relname"', [table]
+        )
+    return [(row['relname'], row['bound']) for row in rows]
+
+async def get_index_valid(conn, name:str):
+    '-> 索引是否可用, 不存在时返回None'
+    rows = await conn.execute_query_dict(
+        'SELECT i."indisvalid" FROM "pg_index" AS i WHERE i."indexrelid" = to_regclass($1)', [name]
+        )
+    if not rows:
+        return None
+    return rows[0]['indisvalid']
+
+async def create_index(conn, name:str, table:str, definition:str, unique=False):
+    '''用CREATE INDEX CONCURRENTLY建索引(不锁表)
+    上次没建完留下的无效索引会先删掉重建 -> 是否新建了索引'''
+    is_valid = await get_index_valid(conn, name)
+    if is_valid:
+        return False
+    if is_valid is not None:
+        logger.warning(f"Rebuilding invalid index: {name}")
+        await conn.execute_script(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    logger.info(f"Creating index: {name}")
+    await conn.execute_script(
+        f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" {definition}'
+        )
+    return True
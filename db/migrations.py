@@ -0,0 +1,237 @@
+'数据库结构升级(generate_schemas只会建新表, 不会改动已有的表)'
+import asyncio
+from loguru import logger
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from . import ddl, partitions
+from .models import GUARD_NAMES, GUARD_PRICES
+
+# 按API的实际查询方式建的索引, 已有的表上建索引会锁表, 所以不写进模型的Meta里,
+# 统一在后台用CREATE INDEX CONCURRENTLY建(新建的空表上也是一瞬间就建好了)
+# 索引名 -> (表名, 索引定义), 索引名都以表名开头, 分区表上每个分区的索引把开头换成分区名
+INDEXES = {
+    # 场次弹幕/刷新场次/字幕
+    'comments_clip_id_time_idx': ('comments', '("clip_id", "time")'),
+    'subtitles_clip_id_time_idx': ('subtitles', '("clip_id", "time")'),
+    # 查询某个用户的发言(按时间倒序)
+    'comments_user_id_time_idx': ('comments', '("user_id", "time" DESC)'),
+    # 舰长记录, 只占大航海那一小部分
+    'comments_guard_user_id_time_idx': ('comments', '("user_id", "time" DESC) WHERE "gift_name" IN ({})'.format(
+        ', '.join(f"'{name}'" for name in GUARD_NAMES)
+        )),
+    # 下播弹幕
+    'offcomments_liver_uid_time_idx': ('offcomments', '("liver_uid", "time")'),
+    # 频道的场次列表/场次数和弹幕数统计
+    'clipinfo_bilibili_uid_start_time_idx': ('clipinfo', '("bilibili_uid", "start_time")'),
+    # 观众发言过的场次(按最后发言时间倒序)/删除场次
+    'viewer_clip_activity_user_id_last_time_idx': ('viewer_clip_activity', '("user_id", "last_time" DESC)'),
+    'viewer_clip_activity_clip_id_idx': ('viewer_clip_activity', '("clip_id")'),
+    # 观众的大航海记录/主播的大航海记录
+    'guard_ledger_user_id_time_idx': ('guard_ledger', '("user_id", "time" DESC)'),
+    'guard_ledger_liver_uid_time_idx': ('guard_ledger', '("liver_uid", "time" DESC)'),
+    # 弹幕/字幕全文搜索, 见api.search
+    'comments_text_grams_idx': ('comments', 'USING gin (danmaku_grams("text"))'),
+    'subtitles_text_grams_idx': ('subtitles', 'USING gin (danmaku_grams("text"))'),
+}
+
+# 文本里所有的单字和相邻两字(去重), 弹幕大多很短, 搜索词也经常只有一两个字,
+# pg_trgm的三字组对这种情况基本用不上, 所以自己建单字+双字的倒排索引
+GRAMS_FUNCTION_SQL = '''
+CREATE OR REPLACE FUNCTION danmaku_grams(t text) RETURNS text[]
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+    SELECT coalesce(array_agg(DISTINCT g), '{}') FROM (
+        SELECT substr(t, i, 1) AS g FROM generate_series(1, length(t)) AS i
+        UNION ALL
+        SELECT substr(t, i, 2) FROM generate_series(1, length(t) - 1) AS i
+    ) AS grams
+$$
+'''
+
+# 与api.parse.content_hash的算法一致: 同一条弹幕在Python和数据库里算出来的哈希相同
+# 旧场次之后又写入了新分段时, 这里按整场编号, 入库时按文件编号, 可能算出已经存在的哈希,
+# 这些行是重复的弹幕, 不补哈希(留空不影响唯一索引)
+CONTENT_HASH_SQL = '''
+UPDATE "comments" AS c SET "content_hash" = h."hash"
+FROM (
+    SELECT "id", md5(concat_ws(chr(31),
+        "clip_id", round(extract(epoch FROM "time") * 1000)::bigint::text, "user_id"::text,
+        "kind"::text, coalesce("text", ''), coalesce("gift_name", ''),
+        (row_number() OVER (
+            PARTITION BY "time", "user_id", "kind", "text", "gift_name" ORDER BY "id"
+            ) - 1)::text
+        ))::uuid AS "hash"
+    FROM (
+        SELECT *, CASE
+            WHEN "superchat_price" IS NOT NULL THEN 2
+            WHEN "gift_name" IS NOT NULL THEN 1
+            ELSE 0 END AS "kind"
+        FROM "comments" WHERE "clip_id" = $1
+    ) AS k
+) AS h
+WHERE c."id" = h."id" AND c."content_hash" IS NULL
+    AND NOT EXISTS (SELECT 1 FROM "comments" AS d WHERE d."content_hash" = h."hash")
+'''
+
+# 按场次重新统计每个观众的发言(不算进场信息), 同一场次的弹幕分几次入库时结果也是对的
+# 礼物和大航海的gift_price都是单价, 金额要乘上数量
+VIEWER_ACTIVITY_SQL = '''
+INSERT INTO "viewer_clip_activity" (
+    "user_id", "clip_id", "username", "first_time", "last_time",
+    "total_danmu", "total_gift", "total_superchat"
+    )
+SELECT "user_id", "clip_id", (array_agg("username" ORDER BY "time" DESC))[1],
+    min("time"), max("time"), count(*),
+    coalesce(sum("gift_price" * coalesce("gift_num", 1)), 0), coalesce(sum("superchat_price"), 0)
+FROM "comments" WHERE "clip_id" = $1 AND NOT "is_misc"
+GROUP BY "user_id", "clip_id"
+ON CONFLICT ("user_id", "clip_id") DO UPDATE SET
+    "username" = EXCLUDED."username",
+    "first_time" = EXCLUDED."first_time",
+    "last_time" = EXCLUDED."last_time",
+    "total_danmu" = EXCLUDED."total_danmu",
+    "total_gift" = EXCLUDED."total_gift",
+    "total_superchat" = EXCLUDED."total_superchat"
+'''
+
+# 大航海每月原价的临时表, 用来从总价推算月数
+GUARD_PRICES_VALUES = 'VALUES {}'.format(', '.join(f"('{name}', {price})" for name, price in GUARD_PRICES.items()))
+
+# 把弹幕里的大航海记录写进guard_ledger(已经写过的跳过), where为空时处理所有场次
+# 旧版本jsonl的大航海存的是总价, gift_num固定为1, 这种按原价推算月数(有折扣时四舍五入, 是近似值), 再换回单价
+GUARD_LEDGER_SQL = '''
+INSERT INTO "guard_ledger" (
+    "comment_id", "clip_id", "liver_uid", "user_id", "username", "time",
+    "gift_name", "gift_price", "gift_num"
+    )
+SELECT c."id", c."clip_id", i."bilibili_uid", c."user_id", c."username", c."time",
+    c."gift_name", coalesce(c."gift_price", 0) / coalesce(m."months", 1), coalesce(m."months", c."gift_num", 1)
+FROM "comments" AS c JOIN "clipinfo" AS i ON i."clip_id" = c."clip_id"
+    JOIN ({prices}) AS u ("gift_name", "price") ON u."gift_name" = c."gift_name"
+    CROSS JOIN LATERAL (
+        SELECT greatest(round(coalesce(c."gift_price", 0) / u."price")::int, 1) AS "months"
+        WHERE coalesce(c."gift_num", 1) = 1
+    ) AS m
+WHERE c."gift_name" IN ({names}) {{where}}
+ON CONFLICT ("comment_id") DO NOTHING
+RETURNING "id"
+'''.format(names=', '.join(f"'{name}'" for name in GUARD_NAMES), prices=GUARD_PRICES_VALUES)
+
+# 修正之前直接按总价写进guard_ledger的旧记录(推算方法同上), 修正过的不会再改
+GUARD_LEDGER_MONTHS_SQL = f'''
+UPDATE "guard_ledger" AS g SET
+    "gift_num" = round(g."gift_price" / u."price")::int,
+    "gift_price" = g."gift_price" / round(g."gift_price" / u."price")
+FROM ({GUARD_PRICES_VALUES}) AS u ("gift_name", "price")
+WHERE u."gift_name" = g."gift_name" AND g."gift_num" = 1 AND round(g."gift_price" / u."price") > 1
+RETURNING g."id"
+'''
+
+async def upgrade():
+    '启动时执行的结构升级, 只做很快就能完成的操作'
+    conn = connections.get('matsuri_db')
+    await conn.execute_script('ALTER TABLE "comments" ADD COLUMN IF NOT EXISTS "content_hash" UUID')
+    await conn.execute_script('ALTER TABLE "clip_archive" ADD COLUMN IF NOT EXISTS "json_data" BYTEA')
+    await conn.execute_script(GRAMS_FUNCTION_SQL)
+
+async def create_indexes():
+    '''在后台建立INDEXES里的索引(CONCURRENTLY, 不锁表)
+    分区表不能直接CONCURRENTLY建索引, 先在主表上建一个空壳索引, 再逐个分区建好挂上去'''
+    conn = connections.get('matsuri_db')
+    for name, (table, definition) in INDEXES.items():
+        if not await ddl.is_partitioned(conn, table):
+            await ddl.create_index(conn, name, table, definition)
+            continue
+        await conn.execute_script(f'CREATE INDEX IF NOT EXISTS "{name}" ON ONLY "{table}" {definition}')
+        if await ddl.get_index_valid(conn, name):
+            continue
+        suffix = name[len(table):]
+        for partition, _ in await ddl.get_partitions(conn, table):
+            attached = await conn.execute_query_dict(
+                'SELECT 1 FROM "pg_inherits" AS i JOIN "pg_index" AS x ON x."indexrelid" = i."inhrelid" '
+                'WHERE i."inhparent" = to_regclass($1) AND x."indrelid" = to_regclass($2)', [name, partition]
+                )
+            if attached:
+                continue
+            partition_index = f"{partition}{suffix}"
+            await ddl.create_index(conn, partition_index, partition, definition)
+            await conn.execute_script(f'ALTER INDEX "{name}" ATTACH PARTITION "{partition_index}"')
+
+# 唯一索引建好之前入库的ON CONFLICT DO NOTHING没有索引可以匹配, 重复的弹幕会写进去, 入库要等它建好
+__content_hash_ready = asyncio.Event()
+
+async def wait_content_hash_index():
+    '等待内容哈希的唯一索引建好(入库前调用)'
+    await __content_hash_ready.wait()
+
+async def create_content_hash_index():
+    '''建内容哈希的唯一索引(CONCURRENTLY, 不锁表), 还没有哈希的旧弹幕是NULL, 不影响建索引
+    之前没有索引时已经写进去的重复哈希只保留第一条, 其余的清空'''
+    conn = connections.get('matsuri_db')
+    # 新建的表和分区表已经有唯一约束(同名), 这时会直接跳过
+    if not await ddl.get_index_valid(conn, 'comments_content_hash_key'):
+        count, _ = await conn.execute_query('''
+            UPDATE "comments" SET "content_hash" = NULL WHERE "id" IN (
+                SELECT "id" FROM (
+                    SELECT "id", row_number() OVER (PARTITION BY "content_hash" ORDER BY "id") AS "n"
+                    FROM "comments" WHERE "content_hash" IS NOT NULL
+                ) AS d WHERE "n" > 1
+            )
+            RETURNING "id"
+            ''')
+        if count:
+            logger.warning(f"Cleared {count} duplicated content hashes")
+        await ddl.create_index(conn, 'comments_content_hash_key', 'comments', '("content_hash")', unique=True)
+    __content_hash_ready.set()
+
+async def backfill_content_hash():
+    '''给旧弹幕逐场次补上内容哈希(需要先建好唯一索引)
+    和入库一样按场次加锁, 不会和同一场次正在写入的弹幕撞哈希; 数据量大时很慢, 在后台运行'''
+    conn = connections.get('matsuri_db')
+    _, rows = await conn.execute_query(
+        'SELECT DISTINCT "clip_id" FROM "comments" WHERE "content_hash" IS NULL'
+        )
+    for idx, row in enumerate(rows):
+        async with in_transaction('matsuri_db') as tx:
+            await tx.execute_query('SELECT pg_advisory_xact_lock(hashtext($1))', [row['clip_id']])
+            await tx.execute_query(CONTENT_HASH_SQL, [row['clip_id']])
+        logger.debug(f"Content hash backfilled: {row['clip_id']} ({idx+1}/{len(rows)})")
+    if rows:
+        logger.info(f"Content hash backfilled for {len(rows)} clips")
+
+async def backfill_viewer_activity():
+    '给还没有观众发言统计的场次逐个补上(数据量大时很慢, 在后台运行)'
+    conn = connections.get('matsuri_db')
+    _, rows = await conn.execute_query(
+        'SELECT "clip_id" FROM "clipinfo" AS c WHERE NOT EXISTS ('
+        'SELECT 1 FROM "viewer_clip_activity" AS v WHERE v."clip_id" = c."clip_id")'
+        )
+    for idx, row in enumerate(rows):
+        await conn.execute_query(VIEWER_ACTIVITY_SQL, [row['clip_id']])
+        logger.debug(f"Viewer activity backfilled: {row['clip_id']} ({idx+1}/{len(rows)})")
+    if rows:
+        logger.info(f"Viewer activity backfilled for {len(rows)} clips")
+
+async def backfill_guard_ledger():
+    '把旧弹幕里的大航海记录补进guard_ledger(只扫描大航海的部分索引, 很快), 顺便修正按总价写进去的旧记录'
+    conn = connections.get('matsuri_db')
+    count, _ = await conn.execute_query(GUARD_LEDGER_SQL.format(where=''))
+    if count:
+        logger.info(f"Guard ledger backfilled: {count} records")
+    count, _ = await conn.execute_query(GUARD_LEDGER_MONTHS_SQL)
+    if count:
+        logger.info(f"Guard ledger months fixed: {count} records")
+
+async def run_background():
+    '''启动后在后台执行的耗时升级
+    先建内容哈希的唯一索引(建好之前不入库), 再转换分区表(开启了分区时), 再建索引(回填哈希时按场次查询要用到)
+    每一步单独处理异常, 一步失败不影响后面的'''
+    steps = [
+        create_content_hash_index, partitions.maintain, create_indexes,
+        backfill_content_hash, backfill_viewer_activity, backfill_guard_ledger,
+    ]
+    for step in steps:
+        try:
+            await step()
+        except Exception:
+            logger.exception(f"Background migration failed: {step.__name__}")
@@ -1,7 +1,10 @@
 from tortoise.models import Model
-from tortoise.fields import SmallIntField, IntField, BigIntField, FloatField, CharField, TextField, DatetimeField, BooleanField, JSONField
+from tortoise.fields import SmallIntField, IntField, BigIntField, FloatField, CharField, TextField, DatetimeField, BooleanField, JSONField, UUIDField, BinaryField
 # from urllib.parse import quote, unquote
 
+GUARD_NAMES = ('总督', '提督', '舰长') # 大航海礼物名称
+GUARD_PRICES = {'总督': 19998, '提督': 1998, '舰长': 198} # 大航海每月的原价(元)
+
 class Token(Model):
     token = TextField(primary_key=True)
     expires = DatetimeField()
@@ -43,6 +46,7 @@ class Subtitles(CommentsBaseModel):
 class Comments(CommentsBaseModel):
     '正常弹幕'
     clip_id = CharField(max_length=36)
+    content_hash = UUIDField(null=True, unique=True) # 用于去重, 见api.parse.content_hash
 
     @classmethod
     async def add(self, **kwargs):
@@ -103,5 +107,67 @@ class ClipInfo(Model):
         ordering = ['-start_time']
         indexes = ['clip_id']
 
+class ViewerClipActivity(Model):
+    '每个观众在每场直播里的发言统计(入库时按场次更新, 见db.migrations.VIEWER_ACTIVITY_SQL)'
+    user_id = BigIntField()
+    clip_id = CharField(max_length=36)
+    username = TextField() # 该场最后一次发言时的用户名
+    first_time = DatetimeField()
+    last_time = DatetimeField()
+    total_danmu = IntField(default=0)
+    total_gift = FloatField(default=0)
+    total_superchat = FloatField(default=0)
+
+    class Meta:
+        table = "viewer_clip_activity"
+        ordering = ['-last_time']
+        unique_together = [('user_id', 'clip_id')]
+
+class GuardLedger(Model):
+    '大航海购买记录(入库时从弹幕里摘出来, 见db.migrations.GUARD_LEDGER_SQL)'
+    comment_id = BigIntField(unique=True) # 对应的弹幕ID
+    clip_id = CharField(max_length=36)
+    liver_uid = BigIntField() # 主播UID
+    user_id = BigIntField()
+    username = TextField()
+    time = DatetimeField()
+    gift_name = TextField() # 总督/提督/舰长
+    gift_price = FloatField()
+    gift_num = SmallIntField() # 月数
+
+    class Meta:
+        table = "guard_ledger"
+        ordering = ['-time']
+
+class ClipArchive(Model):
+    '场次弹幕+字幕的压缩归档(按列存储, 另外存一份序列化好的JSON), 见api.archive'
+    clip_id = CharField(max_length=36, pk=True)
+    codec = CharField(max_length=8) # zstd/zlib
+    data = BinaryField()
+    json_data = BinaryField(null=True) # 压缩后的JSON数组(/clip/{id}/comments直接返回), 之前生成的归档没有
+    total_items = IntField(default=0)
+    pruned = BooleanField(default=False) # 弹幕/字幕表里的数据是否已经删掉
+    updated_at = DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "clip_archive"
+
+class IngestJobs(Model):
+    '待处理的blrec事件(弹幕文件入库任务队列)'
+    event_id = UUIDField(unique=True) # blrec事件ID, webhook重发时不会重复入队
+    event_type = TextField()
+    payload = JSONField()
+    status = CharField(max_length=16, default="pending") # pending/running/done/failed
+    attempts = SmallIntField(default=0)
+    run_after = DatetimeField() # 重试时推迟到这个时间之后
+    created_at = DatetimeField(auto_now_add=True)
+    started_at = DatetimeField(null=True)
+    finished_at = DatetimeField(null=True)
+    error = TextField(null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [('status', 'run_after')]
+
 def __test():
     ClipInfo.get
\ No newline at end of file
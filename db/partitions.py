@@ -0,0 +1,141 @@
+'弹幕表按月分区(PostgreSQL原生范围分区, 按time字段)'
+import datetime, re
+from loguru import logger
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from static import config
+from . import ddl
+
+PARTITIONED_TABLES = ('comments', 'subtitles', 'offcomments')
+UNIQUE_COLUMNS = {'comments': ('content_hash',)} # 除主键外的唯一约束, 分区表上要加上time
+ARCHIVE_SCHEMA = "archive" # 过期分区移到这个schema里, 数据不删除
+TZ_CST = datetime.timezone(datetime.timedelta(seconds=28800)) # 按北京时间分月
+
+def this_month():
+    '-> 当月1日'
+    return datetime.datetime.now(TZ_CST).date().replace(day=1)
+
+def add_months(month:datetime.date, n:int):
+    '-> n个月之后的1日'
+    year, month_idx = divmod(month.month - 1 + n, 12)
+    return datetime.date(month.year + year, month_idx + 1, 1)
+
+def month_literal(month:datetime.date):
+    '-> 当月1日0点(北京时间)的SQL字面量'
+    return f"'{month.isoformat()} 00:00:00+08'"
+
+def bound_end(bound:str):
+    '分区范围(pg_get_expr的结果) -> 上界, 没有上界时返回None'
+    res = re.search(r"TO \('([^']+)'\)", bound)
+    if res is None:
+        return None
+    return datetime.datetime.fromisoformat(res.group(1))
+
+async def convert(conn, table:str):
+    '''把普通表转换成分区表, 不复制数据:
+    原来的表改名为{table}_legacy, 整个作为最早的一个分区(MINVALUE到下下个月)挂上去
+    需要的唯一索引和时间范围约束都提前在原表上建好(不锁写入), 最后只有改名和挂分区需要短暂锁表'''
+    legacy = f"{table}_legacy"
+    boundary = add_months(this_month(), 2)
+    # 分区表的主键和唯一约束必须包含分区字段
+    unique_keys = [('id', f"{table}_id_time_key")] + \
+        [(column, f"{table}_{column}_time_key") for column in UNIQUE_COLUMNS.get(table, ())]
+    for column, name in unique_keys:
+        await ddl.create_index(conn, name, table, f'("{column}", "time")', unique=True)
+    check = f"{legacy}_time_check"
+    rows = await conn.execute_query_dict('SELECT 1 FROM "pg_constraint" WHERE "conname" = $1', [check])
+    if not rows:
+        await conn.execute_script(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{check}" CHECK ("time" < {month_literal(boundary)}) NOT VALID'
+            )
+    await conn.execute_script(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{check}"')
+
+    async with in_transaction('matsuri_db') as tx:
+        await tx.execute_script("SET LOCAL lock_timeout = '10s'")
+        await tx.execute_script(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+        # 原表的索引也跟着改名, 与分区索引的命名方式({分区名}_xxx)保持一致
+        indexes = await tx.execute_query_dict(
+            'SELECT "indexname" FROM "pg_indexes" WHERE "schemaname" = \'public\' AND "tablename" = $1', [legacy]
+            )
+        for row in indexes:
+            name = row['indexname']
+            if name.startswith(f"{table}_") and not name.startswith(f"{legacy}_"):
+                await tx.execute_script(f'ALTER INDEX "{name}" RENAME TO "{legacy}{name[len(table):]}"')
+        # 原来的主键(id)和唯一约束换成提前建好的带time的唯一索引, 挂分区时会直接用上, 不用重新建
+        rows = await tx.execute_query_dict(
+            'SELECT "conname" FROM "pg_constraint" WHERE "conrelid" = to_regclass($1) AND "contype" = \'p\'', [legacy]
+            )
+        for row in rows:
+            await tx.execute_script(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{row["conname"]}"')
+        await tx.execute_script(
+            f'ALTER TABLE "{legacy}" ADD CONSTRAINT "{legacy}_pkey" PRIMARY KEY USING INDEX "{legacy}_id_time_key"'
+            )
+        for column in UNIQUE_COLUMNS.get(table, ()):
+            await tx.execute_script(f'ALTER TABLE "{legacy}" DROP CONSTRAINT IF EXISTS "{legacy}_{column}_key"')
+            await tx.execute_script(f'DROP INDEX IF EXISTS "{legacy}_{column}_key"')
+            await tx.execute_script(
+                f'ALTER TABLE "{legacy}" ADD CONSTRAINT "{legacy}_{column}_time_key" '
+                f'UNIQUE USING INDEX "{legacy}_{column}_time_key"'
+                )
+        await tx.execute_script(
+            f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS) PARTITION BY RANGE ("time")'
+            )
+        rows = await tx.execute_query_dict('SELECT pg_get_serial_sequence($1, \'id\') AS "seq"', [legacy])
+        await tx.execute_script(f'ALTER SEQUENCE {rows[0]["seq"]} OWNED BY "{table}"."id"')
+        await tx.execute_script(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY ("id", "time")')
+        for column in UNIQUE_COLUMNS.get(table, ()):
+            await tx.execute_script(
+                f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_{column}_key" UNIQUE ("{column}", "time")'
+                )
+        await tx.execute_script(
+            f'ALTER TABLE "{table}" ATTACH PARTITION "{legacy}" FOR VALUES FROM (MINVALUE) TO ({month_literal(boundary)})'
+            )
+    logger.info(f"Converted {table} into a partitioned table")
+
+async def create_partitions(conn, table:str, months_ahead:int):
+    '提前建好到months_ahead个月之后为止的分区(已经被其他分区覆盖的月份跳过)'
+    ends = [bound_end(bound) for _, bound in await ddl.get_partitions(conn, table)]
+    last_end = max((end for end in ends if end is not None), default=None)
+    for n in range(months_ahead + 1):
+        month = add_months(this_month(), n)
+        start = datetime.datetime.combine(month, datetime.time(), TZ_CST)
+        if last_end is not None and start < last_end:
+            continue
+        name = f"{table}_p{month:%Y%m}"
+        await conn.execute_script(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table}" '
+            f'FOR VALUES FROM ({month_literal(month)}) TO ({month_literal(add_months(month, 1))})'
+            )
+        logger.info(f"Partition created: {name}")
+
+async def archive_partitions(conn, table:str, retain_months:int):
+    '''把结束时间早于retain_months个月之前的分区摘下来(DETACH CONCURRENTLY, 不锁表),
+    移到archive schema里保存, 不再参与查询'''
+    cutoff = datetime.datetime.combine(add_months(this_month(), -retain_months), datetime.time(), TZ_CST)
+    for name, bound in await ddl.get_partitions(conn, table):
+        end = bound_end(bound)
+        if end is None or end > cutoff:
+            continue
+        await conn.execute_script(f'ALTER TABLE "{table}" DETACH PARTITION "{name}" CONCURRENTLY')
+        await conn.execute_script(f'CREATE SCHEMA IF NOT EXISTS "{ARCHIVE_SCHEMA}"')
+        await conn.execute_script(f'ALTER TABLE "{name}" SET SCHEMA "{ARCHIVE_SCHEMA}"')
+        logger.info(f"Partition archived: {name}")
+
+async def maintain():
+    '''分区维护(启动时和之后每天运行一次):
+    把还没分区的表转换成分区表, 提前建好之后几个月的分区, 归档过期的分区'''
+    if not config.partition.get('enabled', False):
+        return
+    months_ahead = config.partition.get('months_ahead', 3)
+    retain_months = config.partition.get('retain_months', 0)
+    conn = connections.get('matsuri_db')
+    for table in PARTITIONED_TABLES:
+        try:
+            if not await ddl.is_partitioned(conn, table):
+                await convert(conn, table)
+            await create_partitions(conn, table, months_ahead)
+            if retain_months > 0:
+                await archive_partitions(conn, table, retain_months)
+        except Exception:
+            logger.exception(f"Partition maintenance failed: {table}")
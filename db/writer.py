@@ -0,0 +1,42 @@
+'批量写入弹幕'
+from tortoise.models import Model
+
+COMMENT_COLUMNS = (
+    'clip_id', 'time', 'username', 'user_id', 'medal_name', 'medal_level', 'guard_level',
+    'text', 'superchat_price', 'gift_name', 'gift_price', 'gift_num', 'is_misc'
+    ) # Comments/Subtitles共用的字段顺序
+HASHED_COMMENT_COLUMNS = COMMENT_COLUMNS + ('content_hash',) # 带内容哈希的Comments字段顺序
+
+async def bulk_insert(model:type[Model], records:list, columns=COMMENT_COLUMNS, ignore_conflicts=False):
+    '''批量写入, records为与columns顺序一致的tuple列表
+    PostgreSQL(asyncpg)下用COPY ... FROM STDIN, 其他数据库退回到bulk_create
+    ignore_conflicts: 跳过违反唯一约束的行(ON CONFLICT DO NOTHING)
+    -> 实际写入的行数, 用bulk_create跳过冲突时数不出来, 返回None'''
+    if not records:
+        return 0
+    conn = model._meta.db # 在事务里时会拿到事务所在的连接
+    table = model._meta.db_table
+    async with conn.acquire_connection() as raw_conn:
+        if hasattr(raw_conn, 'copy_records_to_table'):
+            if not ignore_conflicts:
+                await raw_conn.copy_records_to_table(table, records=records, columns=columns)
+                return len(records)
+            # COPY本身不能跳过冲突, 先COPY进临时表再INSERT ... ON CONFLICT DO NOTHING
+            staging = f"staging_{table}"
+            column_list = ', '.join(f'"{c}"' for c in columns)
+            await raw_conn.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS "{staging}" AS '
+                f'SELECT {column_list} FROM "{table}" WITH NO DATA'
+                )
+            # 出错时临时表里的数据会随事务一起回滚, 只需要在成功后清空
+            await raw_conn.copy_records_to_table(staging, records=records, columns=columns)
+            status = await raw_conn.execute(
+                f'INSERT INTO "{table}" ({column_list}) SELECT {column_list} FROM "{staging}" '
+                'ON CONFLICT DO NOTHING'
+                )
+            await raw_conn.execute(f'TRUNCATE "{staging}"')
+            return int(status.split()[-1]) # "INSERT 0 n"
+    await model.bulk_create(
+        [model(**dict(zip(columns, r))) for r in records], ignore_conflicts=ignore_conflicts
+        )
+    return None if ignore_conflicts else len(records)
@@ -1,20 +1,21 @@
 from loguru import logger
 
-from typing import Annotated
+from typing import Annotated, Optional
 from ipaddress import ip_address
 from pydantic import BaseModel
 from uuid import UUID
 
 from fastapi import FastAPI, Header, Depends, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-import uvicorn, json, traceback
+import asyncio, uvicorn, json, gzip, traceback
 from contextlib import asynccontextmanager
 
 import db
 from static import config
-from api import matsuri, blrec, auth
+from api import matsuri, blrec, auth, parse, jobs, search, archive, cache, codec
 from db.models import *
 
 import subtitle
@@ -36,19 +37,28 @@ class SearchRequestData(BaseModel):
     endTime: Annotated[str, None]
     page: int       # 传递页码
     pageSize: int # 传递每页大小
+    cursor: Optional[str] = None # 上一页返回的nextCursor, 给了的话忽略page直接接着往后取
 
 
 @asynccontextmanager
 async def lifespan(_app):
     '生命周期管理'
     config.load()
+    parse.init_pool()
     scheduler = await subtitle.init()
     await db.init_db()
+    migration_task = asyncio.create_task(db.migrations.run_background())
+    await jobs.start_workers()
+    scheduler.add_job(db.partitions.maintain, trigger="interval", days=1)
+    scheduler.add_job(archive.prune, trigger="interval", days=1)
 
     yield
 
+    await jobs.stop_workers()
+    migration_task.cancel()
     await db.close()
     scheduler.shutdown()
+    parse.close_pool()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -86,10 +96,20 @@ async def rec_handle(data: BlrecWebhookData, ip_check=Depends(check_ip)):
         # 录制结束
         await blrec.end_clip(data)
     elif event_type == "RawDanmakuFileCompletedEvent":
-        # 原始弹幕完成
-        await blrec.update_clip(data)
+        # 原始弹幕完成, 解析和写入比较慢, 放进队列里后台处理
+        await jobs.enqueue(data)
     return {"code": 200, "message": "Mua~"}
 
+@app.get("/admin/queue")
+async def get_queue_status(ip_check=Depends(check_ip)):
+    '后台任务队列状态'
+    return await jobs.get_status()
+
+@app.get("/admin/cache")
+async def get_cache_status(ip_check=Depends(check_ip)):
+    '频道/场次信息缓存的命中情况'
+    return matsuri.get_metadata_cache_stats()
+
 
 ### 手动刷新接口
 @app.post("/refresh/clip/{clip_id}")
@@ -97,11 +117,21 @@ async def refresh_clip(clip_id: UUID, ip_check=Depends(check_ip)):
     '刷新片段信息'
     res_data = await matsuri.refresh_clip(clip_id)
     if res_data:
+        await matsuri.refresh_viewer_activity(str(clip_id))
+        await matsuri.refresh_guard_ledger(str(clip_id))
+        await matsuri.archive_clip(str(clip_id))
         return res_data
     else:
         raise HTTPException(status_code=404, detail="Clip not found.")
 
 
+@app.post("/refresh/channels")
+async def refresh_channels(ip_check=Depends(check_ip)):
+    '按场次信息重新统计所有直播间的场次数和弹幕数'
+    count = await matsuri.refresh_channels()
+    return {"code": 200, "count": count}
+
+
 @app.post("/delete/clip/{clip_id}")
 async def delete_clip(clip_id: UUID, ip_check=Depends(check_ip)):
     '删除片段信息'
@@ -206,19 +236,68 @@ async def get_clip_id(id:str):
     else:
         raise HTTPException(status_code=404, detail="Clip not found.")
 
+CLIP_COMMENTS_MEDIA_TYPES = {
+    'json': "application/json",
+    'columnar': "application/vnd.matsuri.columnar+json",
+    'msgpack': "application/msgpack",
+} # 场次弹幕的格式 -> Content-Type
+
+def clip_comments_format(req:Request, format:str=None):
+    '''按?format=或者Accept请求头决定场次弹幕的返回格式, 默认为json
+    没装msgpack时不支持msgpack格式'''
+    if format is None:
+        accept = req.headers.get('accept', '')
+        if 'application/msgpack' in accept or 'application/x-msgpack' in accept:
+            format = 'msgpack'
+        elif CLIP_COMMENTS_MEDIA_TYPES['columnar'] in accept:
+            format = 'columnar'
+        else:
+            return 'json'
+    if format not in matsuri.CLIP_COMMENTS_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if format == 'msgpack' and codec.packb is None:
+        raise HTTPException(status_code=406, detail="MessagePack is not available.")
+    return format
+
+async def clip_comments_response(clip_id:str, req:Request, format:str=None):
+    '''场次弹幕的响应: 直接返回缓存里序列化好的数据, 客户端支持时返回gzip压缩版本(很大又没有归档的场次流式返回)
+    带ETag, 内容没变时返回304, 场次更新后(合并分段/添加字幕)客户端和CDN重新验证就能拿到新数据
+    format: 返回格式, 见clip_comments_format'''
+    fmt = clip_comments_format(req, format)
+    entry = await matsuri.get_clip_id_comments_cached(clip_id, config.cache.get('stream_threshold', 50000), fmt)
+    if entry is None:
+        # 很大并且还没有归档的场次: 边读边返回, 返回完之后再在后台生成归档, 下次就能用上缓存了
+        background = BackgroundTask(matsuri.ensure_clip_archive, clip_id) if config.archive.get('enabled', True) else None
+        return StreamingResponse(
+            matsuri.stream_clip_id_comments(clip_id), media_type="application/json",
+            headers={'Cache-Control': 'no-cache'}, background=background
+            )
+    # 压缩和未压缩的是不同的表示, 按协商出来的编码用各自的ETag
+    use_gzip = 'gzip' in req.headers.get('accept-encoding', '')
+    etag = entry['gzip_etag'] if use_gzip else entry['etag']
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept, Accept-Encoding',
+    }
+    if cache.etag_matches(req.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    media_type = CLIP_COMMENTS_MEDIA_TYPES[fmt]
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(entry['gzip'], media_type=media_type, headers=headers)
+    return Response(gzip.decompress(entry['gzip']), media_type=media_type, headers=headers)
+
 @app.get("/clip/{id}/comments")
-async def get_clip_id_comments(id:str, res:Response):
-    'Clip ID -> 所有弹幕(包括礼物)'
-    res_data = await matsuri.get_clip_id_comments(id)
-    res.headers['Cache-Control'] = 'max-age=31536000'
-    return res_data
+async def get_clip_id_comments(id:str, req:Request, format:str=None):
+    '''Clip ID -> 所有弹幕(包括礼物)
+    format: json(默认)/columnar/msgpack, 也可以用Accept请求头指定'''
+    return await clip_comments_response(id, req, format)
 
 @app.get("/clip/{id}/subtitles")
-async def get_clip_id_subtitles(id:str, res:Response):
+async def get_clip_id_subtitles(id:str, req:Request, format:str=None):
     'Clip ID -> 该场直播的语音识别字幕'
-    res_data = await matsuri.get_clip_id_comments(id)
-    res.headers['Cache-Control'] = 'max-age=31536000'
-    return res_data
+    return await clip_comments_response(id, req, format)
 
 # Viewer
 async def check_search(req: Request):
@@ -229,15 +308,33 @@ async def check_search(req: Request):
     return (await auth.check_origin(req)) and (await auth.check_token(req))
 
 @app.get("/viewer/{mid}")
-async def get_viewer_mid(mid:int, page:int, _check=Depends(check_search)):
+async def get_viewer_mid(mid:int, page:int=1, cursor:str=None, _check=Depends(check_search)):
     'MID -> 对应mid发送的弹幕'
-    res_data = await matsuri.get_viewer_mid(mid, page)
+    try:
+        res_data = await matsuri.get_viewer_mid(mid, page, cursor)
+    except search.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return res_data
+
+@app.get("/viewer/{mid}/clips")
+async def get_viewer_mid_clips(mid:int, page:int=1, _check=Depends(check_search)):
+    'MID -> 对应mid发言过的场次和每场的发言统计'
+    res_data = await matsuri.get_viewer_clips(mid, page)
+    return res_data
+
+@app.get("/viewer/{mid}/clips/{clip_id}")
+async def get_viewer_mid_clip_comments(mid:int, clip_id:str, _check=Depends(check_search)):
+    'MID+Clip ID -> 对应mid在该场次发送的弹幕'
+    res_data = await matsuri.get_viewer_clip_comments(mid, clip_id)
     return res_data
 
 @app.get("/search/{danmaku}")
-async def get_search_danmaku(danmaku:str, page:int, _check=Depends(check_search)):
+async def get_search_danmaku(danmaku:str, page:int=1, cursor:str=None, _check=Depends(check_search)):
     'danmaku -> 全局搜索到的弹幕'
-    res_data = await matsuri.get_search_danmaku(danmaku, page)
+    try:
+        res_data = await matsuri.get_search_danmaku(danmaku, page, cursor)
+    except search.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
     return res_data
 
 @app.post("/search_advanced")
@@ -252,6 +349,8 @@ async def get_advanced_search_result(data:SearchRequestData, _check=Depends(chec
 
     try:
         res_data = await matsuri.get_search_advanced(args)
+    except search.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
     except Exception:
         msg = traceback.format_exc()
         return {
@@ -262,9 +361,18 @@ async def get_advanced_search_result(data:SearchRequestData, _check=Depends(chec
         return res_data
 
 @app.get("/guard/{mid}")
-async def get_guard_mid(mid:int, page:int, page_size:int=5):
-    'MID -> 对应mid发送的弹幕'
-    res_data = await matsuri.get_guard(mid, page, page_size)
+async def get_guard_mid(mid:int, page:int=1, page_size:int=5, cursor:str=None):
+    'MID -> 对应mid的大航海记录'
+    try:
+        res_data = await matsuri.get_guard(mid, page, page_size, cursor)
+    except search.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return res_data
+
+@app.get("/guard/{mid}/summary")
+async def get_guard_mid_summary(mid:int):
+    'MID -> 对应mid在每个主播那里的大航海统计'
+    res_data = await matsuri.get_guard_summary(mid)
     return res_data
 
 # Off Comments, 这个因为mid匹配的范围太广会覆盖其他路由，不能放前面
@@ -133,6 +133,11 @@ def update_clip(clip_id):
     logger.info(f"Updating clip {clip_id}..")
     asyncio.run(send_matsuri(api_path=f"/refresh/clip/{clip_id}"))
 
+def reconcile_channels():
+    '按场次信息重新统计所有直播间的场次数和弹幕数'
+    logger.info("Reconciling channels..")
+    asyncio.run(send_matsuri(api_path="/refresh/channels"))
+
 def delete_clip(clip_id):
     '删除场次和弹幕'
     logger.info(f"Deleting clip {clip_id}..")
@@ -174,6 +179,8 @@ def __refresh(args):
         update_channel(args.room)
     if args.clip:
         update_clip(args.clip)
+    if args.channels:
+        reconcile_channels()
 
 def __del(args):
     '删除'
@@ -205,6 +212,7 @@ def main():
     p_ref = sp.add_parser("refresh", help="刷新")
     p_ref.add_argument("--clip", help="场次id")
     p_ref.add_argument("--room", help="直播间id", default=0, type=int)
+    p_ref.add_argument("--channels", help="重新统计所有直播间的场次数和弹幕数", action="store_true")
     p_ref.set_defaults(func=__refresh)
 
     p.add_argument("-c", "--config", help="指定配置文件", default="")
@@ -6,6 +6,13 @@ class __Config:
     __postgres:dict
     __log:dict
     __subtitle:dict
+    __parse:dict
+    __highlight:dict
+    __queue:dict
+    __partition:dict
+    __search:dict
+    __archive:dict
+    __cache:dict
 
     def __init__(self, config_path="config.toml"):
         self.load(config_path)
@@ -30,6 +37,41 @@ class __Config:
         '字幕同步'
         return self.__subtitle
 
+    @property
+    def parse(self):
+        '弹幕文件解析'
+        return self.__parse
+
+    @property
+    def highlight(self):
+        '高能词统计'
+        return self.__highlight
+
+    @property
+    def queue(self):
+        '后台任务队列'
+        return self.__queue
+
+    @property
+    def partition(self):
+        '弹幕表分区'
+        return self.__partition
+
+    @property
+    def search(self):
+        '弹幕搜索'
+        return self.__search
+
+    @property
+    def archive(self):
+        '场次弹幕归档'
+        return self.__archive
+
+    @property
+    def cache(self):
+        '响应缓存'
+        return self.__cache
+
     def load(self, config_path="config.toml"):
         '加载配置'
         with open(config_path, 'r', encoding='utf-8') as f:
@@ -38,6 +80,13 @@ class __Config:
             self.__postgres = config_file['postgres']
             self.__log = config_file['log']
             self.__subtitle = config_file['subtitle']
+            self.__parse = config_file.get('parse', {})
+            self.__highlight = config_file.get('highlight', {})
+            self.__queue = config_file.get('queue', {})
+            self.__partition = config_file.get('partition', {})
+            self.__search = config_file.get('search', {})
+            self.__archive = config_file.get('archive', {})
+            self.__cache = config_file.get('cache', {})
 
 config = __Config()
 
@@ -11,8 +11,9 @@ from tortoise.exceptions import MultipleObjectsReturned, DoesNotExist
 
 from static import config
 from db.models import Subtitles, ClipInfo
+from db.writer import bulk_insert, COMMENT_COLUMNS
 from api.parse import get_cookies, timestamp_to_date, relative_ts_to_time
-from api.matsuri import get_clip_id
+from api.matsuri import get_clip_id, archive_clip
 
 async def get_credential(cookies_dict=None):
     '获取credential'
@@ -148,7 +149,7 @@ async def subtitle_parse(**kwargs):
             "gift_num": 0,
             "is_misc": True
         }
-        res_list.append(Subtitles(**info))
+        res_list.append(tuple(info[c] for c in COMMENT_COLUMNS))
 
     return res_list
 
@@ -189,7 +190,8 @@ async def add_subtitles(**subtitle_config):
     subtitle_list = await subtitle_parse(clip_id=clip_id, **video_info)
 
     # 上传字幕
-    await Subtitles.bulk_create(subtitle_list)
+    await bulk_insert(Subtitles, subtitle_list)
+    await archive_clip(clip_id)
     logger.info(f"Added subtitle for clip {clip_id}")
 
 async def add_subtitles_all(forced=False):